@@ -1,33 +1,89 @@
 """
 announce.py
 """
-from ctypes import resize
+import time
+# 启动计时从导入模块开始
+STARTUP_START = time.perf_counter()
 import os
 import sys
-import time
-import json
 import re
-from urllib.parse import urljoin
-from venv import create
+import shutil
 import webbrowser
-# from jmespath import search
-import requests
-from PyQt6.QtWidgets import (QApplication, QStackedWidget, QTableWidget, QTextBrowser, QVBoxLayout, QWidget, QLabel,
-        QProgressBar, QLineEdit, QPushButton, QTextEdit, QStackedLayout, QRadioButton, QTableWidgetItem,
-        QComboBox, QFileDialog, QGridLayout, QListWidget, QListWidgetItem, QHBoxLayout, QAbstractItemView,
-        QMenu)
-from PyQt6.QtCore import pyqtSignal, QThread, QPoint, Qt
-from PyQt6.QtGui import QFont, QAction, QColor, QPixmap
+import concurrent.futures
+from PyQt6.QtWidgets import (QApplication, QTableWidget, QTextBrowser, QVBoxLayout, QWidget, QLabel,
+        QProgressBar, QLineEdit, QPushButton, QStackedLayout, QRadioButton, QTableWidgetItem,
+        QFileDialog, QGridLayout, QListWidget, QListWidgetItem, QHBoxLayout, QAbstractItemView,
+        QMenu, QTableView)
+from PyQt6.QtCore import pyqtSignal, QThread, QPoint, Qt, QUrl
+from PyQt6.QtGui import QAction, QDesktopServices
 import stockapi
 import createdb
+import quotes
+import collectors
+import downloader
+import docstore
+import pdftext
+import statementstore
+import statementcache
 from test import StockSearchWidget
+from models import StockQuoteModel, AnnouncementTableModel, FinancialStatementModel
 
 
 # 参数
 STOCK_UPDATE_INTERVAL = 10
+# 刷新公告时同时抓取的股票数量
+REFRESH_MAX_WORKERS = 8
+
+
+# 启动各阶段的耗时
+startup_timings = {}
+
+
+def mark_startup(stage):
+    """record the time spent in a stage of the startup, since the previous stage"""
+    startup_timings[stage] = time.perf_counter() - STARTUP_START - sum(startup_timings.values())
+
+
+def format_startup_timings():
+    stages = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in startup_timings.items())
+    return f"startup: {stages}, total {sum(startup_timings.values()) * 1000:.0f} ms"
+
 
+mark_startup("imports")
 
-announcement_db = createdb.AnnouncementDatabase()
+# 由 open_stores 打开，QSqlDatabase 需要在 QApplication 创建之后才能打开
+announcement_db = None
+document_store = None
+statement_store = None
+statement_cache = None
+
+
+def open_stores():
+    """open the database and the local stores used by the pages"""
+    global announcement_db, document_store, statement_store, statement_cache
+    announcement_db = createdb.AnnouncementDatabase()
+    document_store = docstore.DocumentStore(announcement_db)
+    statement_store = statementstore.StatementStore()
+    if statement_store.is_empty():
+        # 第一次运行时导入以前保存的 csv 文件
+        statement_store.import_csv()
+    statement_cache = statementcache.StatementCache(statement_store)
+    mark_startup("database")
+
+
+def open_document(doc_key, url):
+    """
+    已经下载过的文件直接从本地打开；
+    否则在浏览器中打开 url，同时在后台下载到本地缓存，下次打开时使用
+    """
+    path = document_store.get(doc_key)
+    if path is not None:
+        print(f"open {path}")
+        QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(path)))
+        return
+    print(f"open {url}")
+    webbrowser.open(url)
+    document_store.prefetch(doc_key, url)
 
 
 class DownloadWorker(QThread):
@@ -42,33 +98,62 @@ class DownloadWorker(QThread):
         super().__init__()
         self.announcements = announcements
         self.directory = directory
+        # url -> doc_key，下载完成的文件加入本地缓存
+        self.doc_keys = {}
+        self.engine = downloader.DownloadEngine(
+            on_progress=self.update_progress, on_file_done=self.file_done)
 
     def stopRunning(self):
-        """Terminate the thread."""
-        self.terminate()
+        """Stop downloading, unfinished files are resumed next time."""
+        self.engine.stop()
         self.wait()
 
         self.update_value_signal.emit(0)
         self.update_str_signal.emit("下载完成")
 
+    def update_progress(self, done_bytes, total_bytes):
+        """所有下载线程的进度汇总，按字节计算"""
+        if total_bytes > 0:
+            self.update_value_signal.emit(int(done_bytes / total_bytes * 100))
+
+    def file_done(self, url, path, ok):
+        name = os.path.basename(path)
+        if ok:
+            if url in self.doc_keys:
+                try:
+                    document_store.put_file(self.doc_keys[url], url, path)
+                except OSError as e:
+                    print(f"Unable to add {name} to the document store: ", e)
+            self.update_str_signal.emit(f"已下载 {name}")
+        else:
+            self.update_str_signal.emit(f"下载失败 {name}")
+
     def run(self):
         """The thread begins running from here.
         run() is only called after start()."""
-        count = len(self.announcements)
-        for i, ann in enumerate(self.announcements):
+        tasks = []
+        for ann in self.announcements:
             announce_title = ann["announcementTitle"]
             sec_name = re.sub("</{0,1}em>", "", ann["secName"])
-            progress_str = f"正在下载 {sec_name} {announce_title}"
-
-            response = requests.get(ann["ann_dl_url"])
             file_name = f"{sec_name}：{announce_title}.pdf"
-            file_name = os.path.join(self.directory, file_name)
-            with open(file_name, "wb") as file:
-                file.write(response.content)
-            progress_val = int((i + 1) / count * 100)
-            self.update_value_signal.emit(progress_val)
-            self.update_str_signal.emit(progress_str)
-        self.stopRunning()
+            path = os.path.join(self.directory, file_name)
+            if "announcementId" in ann:
+                doc_key = docstore.announcement_doc_key(ann["announcementId"])
+                cached = document_store.get(doc_key)
+                if cached is not None:
+                    # 其它目录或之前已经下载过，直接从本地缓存复制
+                    if not os.path.exists(path):
+                        shutil.copyfile(cached, path)
+                    self.update_str_signal.emit(f"已复制 {file_name}")
+                    continue
+                self.doc_keys[ann["ann_dl_url"]] = doc_key
+            tasks.append((ann["ann_dl_url"], path))
+
+        failed = self.engine.download_all(tasks)
+        announcement_db.close_thread_connection()
+        mb = self.engine.done_bytes / 1024 / 1024
+        self.update_value_signal.emit(100)
+        self.update_str_signal.emit(f"下载完成，共 {mb:.1f} MB，失败 {len(failed)} 个")
 
 
 class UpdateStockWorker(QThread):
@@ -96,13 +181,58 @@ class UpdateStockWorker(QThread):
         self.start_update = True
 
         while self.start_update:
-            stocks_data = []
-            for code in self.codes:
-                data = stockapi.get_market_data(code)
-                if data != {}:
-                    stocks_data.append(data)
+            start = time.time()
+            stocks_data = quotes.get_market_data_many(self.codes)
             self.stock_data_ready_signal.emit(stocks_data)
-            time.sleep(interval)
+            # 扣除本轮请求所花的时间，保证刷新周期稳定
+            time.sleep(max(0, interval - (time.time() - start)))
+
+
+class RefreshAnnouncementsWorker(QThread):
+    """
+    Create worker thread for fetching the latest announcements
+    of the selected stocks
+    """
+    announcements_ready_signal = pyqtSignal(object)
+    refresh_finished_signal = pyqtSignal(int)
+
+    def __init__(self, codes):
+        super().__init__()
+        self.codes = codes
+
+    def run(self):
+        inserted = collectors.collect_announcements(
+            announcement_db, self.codes, REFRESH_MAX_WORKERS,
+            lambda code, rows: self.announcements_ready_signal.emit(rows))
+        announcement_db.close_thread_connection()
+        self.refresh_finished_signal.emit(inserted)
+
+
+class RefreshStudyReportsWorker(QThread):
+    """在后台并行抓取自选股的新研报，全部写入数据库后发出新报告的 rowid"""
+    reports_inserted_signal = pyqtSignal(object)
+
+    def __init__(self, codes):
+        super().__init__()
+        self.codes = codes
+
+    def run(self):
+        rowids = collectors.collect_study_reports(announcement_db, self.codes, REFRESH_MAX_WORKERS)
+        if rowids:
+            announcement_db.refresh_consensus()
+        announcement_db.close_thread_connection()
+        self.reports_inserted_signal.emit(rowids)
+
+
+class TextIndexWorker(QThread):
+    """在后台提取已缓存的 pdf 文件的文本，建立全文索引"""
+    index_finished_signal = pyqtSignal(str)
+
+    def run(self):
+        stats = pdftext.index_documents(announcement_db, document_store)
+        announcement_db.close_thread_connection()
+        if stats["files"] > 0:
+            self.index_finished_signal.emit(pdftext.format_stats(stats))
 
 
 class DownloadReportWidget(QWidget):
@@ -173,20 +303,26 @@ class SelectedStocksWidget(QWidget):
 
     def setUpMainWindow(self):
         """set up main window"""
-        self.stocks_table = QTableWidget()
-        self.stocks_table.setColumnCount(8)
-        self.stocks_table.setRowCount(len(self.selected_stocks))
+        self.stocks_model = StockQuoteModel(self.selected_stocks)
+        # 先显示 ingest.py 保存的行情，不等待第一次请求
+        self.stocks_model.update_quotes(announcement_db.query_quotes(self.selected_stocks))
+        self.stocks_table = QTableView()
+        self.stocks_table.setModel(self.stocks_model)
         self.stocks_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
         self.stocks_table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
         self.stocks_table.verticalHeader().setVisible(False)
-        header_labels = ["名称", "代码", "最新", "涨幅", "涨跌", "市盈TTM", "市净", "总市值"]
-        self.stocks_table.setHorizontalHeaderLabels(header_labels)
 
         # Create layout and arrange widgets
         box = QVBoxLayout()
         box.addWidget(self.stocks_table)
         self.setLayout(box)
 
+    def update_watchlist(self):
+        """自选股列表变化后，同步更新 worker 和表格的行"""
+        self.selected_stocks = announcement_db.query_stocks()
+        self.update_stock_worker.update_database()
+        self.stocks_model.set_watchlist(self.selected_stocks)
+
     def add_stock(self, stock_info):
         # print(stock_info)
         # print(stock_info.split())
@@ -195,9 +331,8 @@ class SelectedStocksWidget(QWidget):
         category = split[1]
         name = split[2]
         # code, category, name = stock_info.split(" ")
-        announcement_db.insert_stock(code, name, category)
-        self.update_stock_worker.update_database()
-        # self.display_stocks_data()
+        announcement_db.insert_stock(code, name, category).result()
+        self.update_watchlist()
 
     def contextMenuEvent(self, event):
         delete_action = QAction("删除", self)
@@ -208,76 +343,20 @@ class SelectedStocksWidget(QWidget):
         action = context_menu.exec(self.mapToGlobal(event.pos()))
 
         if action == delete_action:
-            # 因为每一行所有的 item 拥有相同的 row，所以 rows 中的列表有重复项，因此需要去重
-            rows = [item.row() for item in self.stocks_table.selectedItems()]
-            rows = list(set(rows))
+            rows = [index.row() for index in self.stocks_table.selectionModel().selectedRows()]
             print(rows)
 
+            futures = []
             for row in rows:
-                code = self.stocks_table.item(row, 1).text()
+                code = self.stocks_model.code(row)
                 print(code)
-                announcement_db.delete_stock(code)
-            self.update_stock_worker.update_database()
-
-        # self.display_stocks_data()
+                futures.append(announcement_db.delete_stock(code))
+            concurrent.futures.wait(futures)
+            self.update_watchlist()
 
     def display_stocks_data(self, stocks_data):
-        self.stocks_table.setRowCount(0)
-        self.stocks_table.clearContents()
-
-        self.stocks_table.setRowCount(len(stocks_data))
-
-        for i, data in enumerate(stocks_data):
-            change_rate = float(data["ChangeRate"])
-            if change_rate > 0:
-                color = QColor("#ff4343")
-            else:
-                color = QColor("#07a168")
-
-            item = QTableWidgetItem(data["Name"])
-            item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 0, item)
-
-            item = QTableWidgetItem(data["Code"])
-            item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 1, item)
-
-            latest_price = float(data["LatestPrice"])
-            item = QTableWidgetItem(f"{latest_price:.2f}")
-            item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 2, item)
-
-            item = QTableWidgetItem(f"{change_rate:.2f}%")
-            item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 3, item)
-
-            change_amount = float(data["ChangeAmount"])
-            item = QTableWidgetItem(f"{change_amount:.2f}")
-            item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 4, item)
-
-            pe_ttm = float(data["PETTM"])
-            item = QTableWidgetItem(f"{pe_ttm:.1f}")
-            item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 5, item)
-
-            pb = float(data["PB"])
-            item = QTableWidgetItem(f"{pb:.1f}")
-            item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 6, item)
-
-            market_value = float(data["MarketValue"])
-            item = QTableWidgetItem(f"{market_value:.0f}亿")
-            item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-            item.setForeground(color)
-            self.stocks_table.setItem(i, 7, item)
+        """只更新发生变化的单元格，不重建表格"""
+        self.stocks_model.update_quotes(stocks_data)
 
 
 class LatestAnnouncementWidget(QWidget):
@@ -285,6 +364,7 @@ class LatestAnnouncementWidget(QWidget):
     def __init__(self):
         super().__init__()
         self.selected_stocks = announcement_db.query_stocks()
+        self.search_text = ""
         self.initializeUI()
 
     def initializeUI(self):
@@ -294,76 +374,73 @@ class LatestAnnouncementWidget(QWidget):
 
     def setUpMainWindow(self):
         """set up main window"""
-        self.announcements_table = QTableWidget()
-        self.announcements_table.setColumnCount(3)
+        # 公告按页从数据库读取，滚动到底部时再读取下一页
+        self.announcements_model = AnnouncementTableModel(
+            announcement_db.query_announcements_page, createdb.ANNOUNCEMENT_PAGE_SIZE)
+        self.announcements_table = QTableView()
+        self.announcements_table.setModel(self.announcements_model)
         self.announcements_table.setColumnWidth(0, 20)
         self.announcements_table.setColumnWidth(1, 800)
         self.announcements_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
         self.announcements_table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
-        self.announcements_table.setHorizontalHeaderLabels(["序号", "公告标题", "公告时间"])
         self.announcements_table.verticalHeader().setVisible(False)
-        self.announcements_table.itemClicked.connect(self.read)
-        self.announcements_table.itemDoubleClicked.connect(self.open)
+        self.announcements_table.clicked.connect(self.read)
+        self.announcements_table.doubleClicked.connect(self.open)
+
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("搜索公告标题")
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.returnPressed.connect(self.search_announcements)
+        self.search_edit.textChanged.connect(self.search_text_changed)
 
         self.refresh_btn = QPushButton("刷新")
         self.refresh_btn.clicked.connect(self.refresh_announcements)
 
-        self.display_announcements()
-
         # Create layout and arrange widgets
         box = QVBoxLayout()
+        box.addWidget(self.search_edit)
         box.addWidget(self.announcements_table)
         box.addWidget(self.refresh_btn)
         self.setLayout(box)
 
-    def clear_announcements(self):
-        """删除所有公告"""
-        self.all_announcements = []
-        self.announcements_table.setRowCount(0)
-        self.announcements_table.clearContents()
-
     def display_announcements(self):
-        """把公告从数据库里读取出来，并显示"""
-        self.clear_announcements()
-        self.all_announcements = announcement_db.query_announcements()
-        self.announcements_table.setRowCount(len(self.all_announcements))
-
-        font = self.announcements_table.font()
-        font.setBold(True)
-        for i, ann in enumerate(self.all_announcements):
-            ann_title = f'{ann["Name"]}: {ann["AnnouncementTitle"]}'
-            ann_date = ann["AnnouncementDate"]
-            if ann["AnnouncementState"] != "DELETED":
-                num_item = QTableWidgetItem(f"{i+1}")
-                num_item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
-                self.announcements_table.setItem(i, 0, num_item)
-                self.announcements_table.setItem(i, 1, QTableWidgetItem(ann_title))
-                self.announcements_table.setItem(i, 2, QTableWidgetItem(ann_date))
-                if ann["AnnouncementState"] == "UNREAD":
-                    font.setBold(True)
-                    self.announcements_table.item(i, 1).setFont(font)
-                elif ann["AnnouncementState"] == "READ":
-                    font.setBold(False)
-                    self.announcements_table.item(i, 1).setFont(font)
+        """重新从数据库读取公告，只读取第一页"""
+        self.announcements_model.reload()
+
+    def search_announcements(self):
+        """在本地全文索引中搜索公告标题，按匹配程度排序"""
+        text = self.search_edit.text().strip()
+        self.search_text = text
+        if not text:
+            self.announcements_model.set_fetch_page(announcement_db.query_announcements_page)
+            return
+        # 搜索结果只有一页
+        self.announcements_model.set_fetch_page(
+            lambda after, limit: [] if after else announcement_db.search_announcements(text))
+
+    def search_text_changed(self, text):
+        """清空搜索框后回到公告列表"""
+        if not text:
+            self.search_announcements()
 
     def refresh_announcements(self):
-        """从网站抓取数据，并更新数据库"""
-        self.all_announcements = []
-        for code in self.selected_stocks:
-            announcements = stockapi.get_latest_announcement2(code, size=1)
-            self.all_announcements = self.all_announcements + announcements
-
-        for ann in self.all_announcements:
-            ann_id = ann["AnnouncementId"]
-            code = ann["Code"]
-            name = ann["Name"]
-            title = ann["AnnouncementTitle"]
-            ann_date = ann["AnnouncementDate"]
-            url = ann["AnnouncementUrl"]
-            state = "UNREAD"
-            announcement_db.insert_announcement(int(ann_id), code, name, title, ann_date, url, state, reverse=False)
-
-        self.display_announcements()
+        """在后台线程从网站抓取数据，每只股票抓取完成后就写入数据库并显示"""
+        self.selected_stocks = announcement_db.query_stocks()
+        self.refresh_btn.setEnabled(False)
+        self.refresh_worker = RefreshAnnouncementsWorker(self.selected_stocks)
+        self.refresh_worker.announcements_ready_signal.connect(self.announcements_ready)
+        self.refresh_worker.refresh_finished_signal.connect(self.refresh_finished)
+        self.refresh_worker.start()
+
+    def announcements_ready(self, announcements):
+        if self.search_text:
+            # 正在显示搜索结果，不插入新公告
+            return
+        self.announcements_model.merge_announcements(announcements)
+
+    def refresh_finished(self, inserted):
+        print(f"{inserted} announcements inserted")
+        self.refresh_btn.setEnabled(True)
 
     def create_actions(self):
         """add actions in the context menu"""
@@ -377,51 +454,40 @@ class LatestAnnouncementWidget(QWidget):
         self.open_act.triggered.connect(self.open)
         self.delete_act.triggered.connect(self.delete)
 
-    def read(self):
-        # 首先获取被选中的行号列表，并去重
-        rows = [item.row() for item in self.announcements_table.selectedItems()]
-        rows = list(set(rows))
+    def selected_rows(self):
+        """被选中的行号列表"""
+        return [index.row() for index in self.announcements_table.selectionModel().selectedRows()]
 
-        for row in rows:
-            ann_id = self.all_announcements[row]["AnnouncementId"]
+    def read(self):
+        for row in self.selected_rows():
+            ann_id = self.announcements_model.announcement(row).ann_id
             state = "READ"
-            announcement_db.update_announcement_state(int(ann_id), state)
-            font = self.announcements_table.font()
-            font.setBold(False)
-            self.announcements_table.item(row, 1).setFont(font)
+            announcement_db.update_announcement_state(ann_id, state)
+            self.announcements_model.set_state(row, state)
 
     def unread(self):
-        # 首先获取被选中的行号列表，并去重
-        rows = [item.row() for item in self.announcements_table.selectedItems()]
-        rows = list(set(rows))
-
-        for row in rows:
-            ann_id = self.all_announcements[row]["AnnouncementId"]
+        for row in self.selected_rows():
+            ann_id = self.announcements_model.announcement(row).ann_id
             state = "UNREAD"
-            announcement_db.update_announcement_state(int(ann_id), state)
-            font = self.announcements_table.font()
-            font.setBold(True)
-            self.announcements_table.item(row, 1).setFont(font)
+            announcement_db.update_announcement_state(ann_id, state)
+            self.announcements_model.set_state(row, state)
 
     def delete(self):
-        rows = [item.row() for item in self.announcements_table.selectedItems()]
-        rows = list(set(rows))
+        rows = self.selected_rows()
         rows.sort(reverse=True)
 
         for row in rows:
-            print(self.all_announcements[row]["AnnouncementTitle"])
-            self.announcements_table.removeRow(row)
-            ann_id = self.all_announcements[row]["AnnouncementId"]
+            ann = self.announcements_model.announcement(row)
+            print(ann.title)
             state = "DELETED"
-            del self.all_announcements[row]
-            announcement_db.update_announcement_state(int(ann_id), state)
+            announcement_db.update_announcement_state(ann.ann_id, state)
+            self.announcements_model.remove_row(row)
 
     def open(self):
         self.read()
-        row = self.announcements_table.currentRow()
-        url = self.all_announcements[row]["AnnouncementUrl"]
-        print(f"open {url}")
-        webbrowser.open(url)
+        row = self.announcements_table.currentIndex().row()
+        ann = self.announcements_model.announcement(row)
+        open_document(docstore.announcement_doc_key(ann.ann_id), ann.url)
 
     def contextMenuEvent(self, event):
         context_menu = QMenu(self)
@@ -463,6 +529,12 @@ class StudyReportWidget(QWidget):
         # self.report_table.itemClicked.connect(self.read)
         # self.report_table.itemDoubleClicked.connect(self.open)
 
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("搜索标题、机构、作者、行业")
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.returnPressed.connect(self.search_reports)
+        self.search_edit.textChanged.connect(self.search_text_changed)
+
         self.refresh_btn = QPushButton("刷新")
         self.refresh_btn.clicked.connect(self.refresh_study_reports)
 
@@ -470,6 +542,7 @@ class StudyReportWidget(QWidget):
 
         # Create layout and arrange widgets
         box = QVBoxLayout()
+        box.addWidget(self.search_edit)
         box.addWidget(self.report_table)
         box.addWidget(self.refresh_btn)
         self.setLayout(box)
@@ -480,33 +553,75 @@ class StudyReportWidget(QWidget):
         self.report_table.setRowCount(0)
         self.report_table.clearContents()
 
-    def display_reports(self):
-        """显示研究报告"""
+    def display_reports(self, reports=None):
+        """显示研究报告，reports 为 None 时显示数据库中所有报告"""
         self.report_table.setRowCount(0)
         self.report_table.clearContents()
 
-        self.all_study_reports = announcement_db.query_study_reports()
+        if reports is None:
+            reports = announcement_db.query_study_reports()
+        self.all_study_reports = reports
         self.report_table.setRowCount(len(self.all_study_reports))
         for i, report in enumerate(self.all_study_reports):
-            num_item = QTableWidgetItem(f"{i+1}")
-            report["Title"] = report["StockName"] + "：" + report["Title"]
-            self.report_table.setItem(i, 0, num_item)
-
-            headers = ["Title", "EmRatingName", "Authors", "OrgShortName", "PublishDate"]
-            for j, header in enumerate(headers):
-                item = QTableWidgetItem(report[header])
-                self.report_table.setItem(i, j+1, item)
+            self.set_report_row(i, report)
+
+    def set_report_row(self, row, report):
+        """fill a row of the table with a StudyReport"""
+        num_item = QTableWidgetItem(f"{row+1}")
+        self.report_table.setItem(row, 0, num_item)
+
+        values = [f"{report.stock_name}：{report.title}", report.em_rating_name, report.authors,
+                  report.org_name, report.publish_date]
+        for j, value in enumerate(values):
+            item = QTableWidgetItem("" if value is None else str(value))
+            if report.snippet is not None:
+                item.setToolTip(report.snippet)
+            self.report_table.setItem(row, j+1, item)
+
+    def insert_reports(self, reports):
+        """insert new reports at their positions by publish date, the other rows are kept"""
+        first = len(self.all_study_reports)
+        for report in reports:
+            row = 0
+            while (row < len(self.all_study_reports)
+                   and self.all_study_reports[row].publish_date >= report.publish_date):
+                row += 1
+            self.all_study_reports.insert(row, report)
+            self.report_table.insertRow(row)
+            self.set_report_row(row, report)
+            first = min(first, row)
+        # 序号列跟着变化
+        for row in range(first, len(self.all_study_reports)):
+            self.report_table.item(row, 0).setText(f"{row+1}")
+
+    def search_reports(self):
+        """在本地全文索引中搜索研究报告，按匹配程度排序"""
+        text = self.search_edit.text().strip()
+        if not text:
+            self.display_reports()
+            return
+        self.display_reports(announcement_db.search_study_reports(text))
+
+    def search_text_changed(self, text):
+        """清空搜索框后显示所有报告"""
+        if not text:
+            self.display_reports()
 
     def refresh_study_reports(self):
-        self.all_study_reports = []
-        for code in self.selected_stocks:
-            reports = stockapi.get_study_reports(code)
-            self.all_study_reports = self.all_study_reports + reports
-
-        for report_obj in self.all_study_reports:
-            announcement_db.insert_study_report(report_obj)
-        
-        self.display_reports()
+        """在后台线程抓取新研报，完成后只插入新增的行"""
+        self.selected_stocks = announcement_db.query_stocks()
+        self.refresh_btn.setEnabled(False)
+        self.refresh_worker = RefreshStudyReportsWorker(self.selected_stocks)
+        self.refresh_worker.reports_inserted_signal.connect(self.reports_inserted)
+        self.refresh_worker.start()
+
+    def reports_inserted(self, rowids):
+        print(f"{len(rowids)} study reports inserted")
+        self.refresh_btn.setEnabled(True)
+        if not rowids or self.search_edit.text().strip():
+            # 正在显示搜索结果，不插入新报告
+            return
+        self.insert_reports(announcement_db.query_study_reports_by_rowids(rowids))
 
     def create_actions(self):
         """add actions in the context menu"""
@@ -515,9 +630,8 @@ class StudyReportWidget(QWidget):
 
     def open(self):
         row = self.report_table.currentRow()
-        url = self.all_study_reports[row]["PdfUrl"]
-        print(f"open {url}")
-        webbrowser.open(url)
+        report = self.all_study_reports[row]
+        open_document(docstore.study_report_doc_key(report.info_code), report.url)
 
     def contextMenuEvent(self, event):
         context_menu = QMenu(self)
@@ -532,6 +646,8 @@ class FinancialStatementWidget(QWidget):
         super().__init__()
         self.category = "zcfzb"
         self.code = ""
+        # 当前股票已经读取的报表 model，切换报表类型时直接替换 model
+        self.statement_models = {}
         self.initializeUI()
 
     def initializeUI(self):
@@ -559,7 +675,7 @@ class FinancialStatementWidget(QWidget):
         # search_edit = StockSearchWidget()
         # search_edit.complete.connect(self.update_code)
         # 显示财务报表的table
-        self.financial_table = QTableWidget()
+        self.financial_table = QTableView()
 
         box = QVBoxLayout()
         # box.addWidget(code_label)
@@ -586,23 +702,18 @@ class FinancialStatementWidget(QWidget):
         code = stock_str.split(" ")[0]
         if self.code != code:
             self.code = code
+            self.statement_models = {}
             self.update_financial_statement()
 
     def update_financial_statement(self):
         """获取给定股票的财务报表，并显示"""
-        statement = stockapi.get_financial_statement(self.code, self.category)
-        horizontal_headers = statement[0][1:]
-        vertical_headers = [item[0] for item in statement][1:]
-        row = len(vertical_headers)
-        column = len(horizontal_headers)
-        self.financial_table.setRowCount(row)
-        self.financial_table.setColumnCount(column)
-        self.financial_table.setVerticalHeaderLabels(vertical_headers)
-        self.financial_table.setHorizontalHeaderLabels(horizontal_headers)
-        for i, line in enumerate(statement[1:]):
-            for j, item in enumerate(line[1:]):
-                item_obj = QTableWidgetItem(item)
-                self.financial_table.setItem(i, j, item_obj)
+        model = self.statement_models.get(self.category)
+        if model is None:
+            # 只有可能有新的报告时才重新下载
+            statement = statement_cache.get(self.code, self.category)
+            model = FinancialStatementModel(statement, self)
+            self.statement_models[self.category] = model
+        self.financial_table.setModel(model)
 
 class MainWindow(QWidget):
     "股票投资助手程序的主界面"
@@ -626,6 +737,11 @@ class MainWindow(QWidget):
         self.setUpMainWindow()
         self.show()
 
+        # 启动时为新缓存的 pdf 文件建立全文索引
+        self.text_index_worker = TextIndexWorker()
+        self.text_index_worker.index_finished_signal.connect(print)
+        self.text_index_worker.start()
+
     def setUpMainWindow(self):
         """
         setup main window
@@ -674,15 +790,13 @@ class MainWindow(QWidget):
         maximize_btn.clicked.connect(self.maximize_window)
         close_btn.clicked.connect(self.close)
 
-        info_pages = [
-            {"Title": "公告", "PageWidget": LatestAnnouncementWidget()},
-            {"Title": "研报", "PageWidget": StudyReportWidget()}
-        ]
-
+        # 导航栏的每一项对应 self.page_classes 中的一个页面，或者一组标签页
         self.pages_obj = [
-            {"Title": "自选", "PageWidget": SelectedStocksWidget()},
-            {"Title": "资讯", "PageWidget": info_pages},
-            {"Title": "财务", "PageWidget": FinancialStatementWidget()}
+            {"Title": "自选", "Page": "SelectedStocks"},
+            {"Title": "资讯", "Page": [
+                {"Title": "公告", "Page": "LatestAnnouncement"},
+                {"Title": "研报", "Page": "StudyReport"}]},
+            {"Title": "财务", "Page": "FinancialStatement"}
         ]
 
         # ============== 左侧导航栏 =====================
@@ -696,23 +810,16 @@ class MainWindow(QWidget):
         self.sel.currentRowChanged.connect(self.switch_page)
 
         # =============== 右侧界面 ======================
-        self.pages = {
-            "SelectedStocks": SelectedStocksWidget(),
-            "DownloadReport": DownloadReportWidget(),
-            "LatestAnnouncement": LatestAnnouncementWidget(),
-            "FinancialStatement": FinancialStatementWidget(),
-            "StudyReport": StudyReportWidget()
+        # 页面在第一次显示时才创建，每个页面只有一个实例
+        self.page_classes = {
+            "SelectedStocks": SelectedStocksWidget,
+            "DownloadReport": DownloadReportWidget,
+            "LatestAnnouncement": LatestAnnouncementWidget,
+            "FinancialStatement": FinancialStatementWidget,
+            "StudyReport": StudyReportWidget
         }
+        self.pages = {}
         self.stack = QStackedLayout()
-        for item in self.pages_obj:
-            if isinstance(item["PageWidget"], list):
-                for page in item["PageWidget"]:
-                    self.stack.addWidget(page["PageWidget"])
-            elif isinstance(item["PageWidget"], QWidget):
-                self.stack.addWidget(item["PageWidget"])
-
-        # for _, widget in self.pages.items():
-        #     self.stack.addWidget(widget)
 
         # ================== 主界面 =======================
         main_h_box = QHBoxLayout()
@@ -726,14 +833,28 @@ class MainWindow(QWidget):
         main_v_box.addLayout(main_h_box)
 
         self.setLayout(main_v_box)
+        self.sel.setCurrentRow(0)
+
+    def page(self, name):
+        """return the page widget of name, create it on first use"""
+        if name not in self.pages:
+            start = time.perf_counter()
+            self.pages[name] = self.page_classes[name]()
+            self.stack.addWidget(self.pages[name])
+            print(f"page {name} created in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return self.pages[name]
+
+    def show_page(self, name):
+        self.stack.setCurrentWidget(self.page(name))
 
     # ============ 槽函数 =================
     def stock_search_complete(self, stock_str):
-        if self.stack.currentWidget() == self.pages["SelectedStocks"]:
+        current = self.stack.currentWidget()
+        if current is self.pages.get("SelectedStocks"):
             self.pages["SelectedStocks"].add_stock(stock_str)
-        elif self.stack.currentWidget() == self.pages["DownloadReport"]:
+        elif current is self.pages.get("DownloadReport"):
             self.pages["DownloadReport"].update_announcement_tedit(stock_str)
-        elif self.stack.currentWidget() == self.pages["FinancialStatement"]:
+        elif current is self.pages.get("FinancialStatement"):
             self.pages["FinancialStatement"].update_code(stock_str)
 
     def minimize_window(self):
@@ -747,18 +868,19 @@ class MainWindow(QWidget):
 
     def switch_page(self, row):
         """slot for switching between tabs"""
-        if isinstance(self.pages_obj[row]["PageWidget"], QWidget):
-            self.stack.setCurrentWidget(self.pages_obj[row]["PageWidget"])
+        if isinstance(self.pages_obj[row]["Page"], str):
+            self.show_page(self.pages_obj[row]["Page"])
             if len(self.tab_btns) > 0:
                 for btn in self.tab_btns:
                     btn.setVisible(False)
-        elif isinstance(self.pages_obj[row]["PageWidget"], list):
+        elif isinstance(self.pages_obj[row]["Page"], list):
             if len(self.tab_btns) == 0:
-                for item in self.pages_obj[row]["PageWidget"]:
+                for item in self.pages_obj[row]["Page"]:
                     btn = QPushButton(item["Title"])
                     btn.setObjectName("TabButton")
                     btn.setCheckable(True)
                     btn.setCursor(Qt.CursorShape.PointingHandCursor)
+                    btn.setProperty("Page", item["Page"])
                     btn.clicked.connect(self.tab_btn_click)
                     self.tab_btn_box.addWidget(btn)
                     self.tab_btns.append(btn)
@@ -799,21 +921,16 @@ class MainWindow(QWidget):
     #     self.progress_label.setText(progress_str)
 
     def tab_btn_click(self):
-        pass
-    #     for btn in self.tab_btns:
-    #         if btn is self.sender():
-    #             text = btn.text()
-    #             if not btn.isChecked():
-    #                 btn.setChecked(True)
-    #         else:
-    #             btn.setChecked(False)
-
-    #     for item in self.pages_obj:
-    #         if isinstance(item["PageWidget"], list):
-    #             for page in item["PageWidget"]:
-    #                 if page["Title"] == text:
-    #                     self.stack.setCurrentWidget(page["PageWidget"])
+        """选中被点击的标签，显示它的页面"""
+        for btn in self.tab_btns:
+            btn.setChecked(btn is self.sender())
+        self.show_page(self.sender().property("Page"))
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if "first paint" not in startup_timings:
+            mark_startup("first paint")
+            print(format_startup_timings())
 
     def closeEvent(self, event):
         sys.exit(app.exec())
@@ -840,5 +957,7 @@ class MainWindow(QWidget):
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    open_stores()
     window = MainWindow()
+    mark_startup("window")
     sys.exit(app.exec())
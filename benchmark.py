@@ -0,0 +1,309 @@
+"""
+benchmark.py
+性能测试脚本
+
+用法: python benchmark.py [name ...]，不带参数时运行全部测试
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+
+def make_quotes(count):
+    """generate fake quotes in the format of quotes.get_market_data_many"""
+    stocks_data = []
+    for i in range(count):
+        stocks_data.append({
+            "Code": f"{i:06d}",
+            "Name": f"股票{i}",
+            "LatestPrice": random.uniform(1, 100),
+            "ChangeRate": random.uniform(-10, 10),
+            "ChangeAmount": random.uniform(-1, 1),
+            "PETTM": random.uniform(5, 50),
+            "PB": random.uniform(0.5, 10),
+            "MarketValue": random.uniform(10, 20000)})
+    return stocks_data
+
+
+def tick_quotes(stocks_data, ratio=0.1):
+    """change the price of about ratio of the stocks, like a real tick"""
+    stocks_data = [dict(data) for data in stocks_data]
+    for data in random.sample(stocks_data, max(1, int(len(stocks_data) * ratio))):
+        data["LatestPrice"] += 0.01
+        data["ChangeRate"] += 0.01
+        data["ChangeAmount"] += 0.01
+    return stocks_data
+
+
+def rebuild_table_widget(table, stocks_data):
+    """the old repaint path: clear the table and create 8 items per stock"""
+    from PyQt6.QtWidgets import QTableWidgetItem
+    from PyQt6.QtGui import QColor
+
+    table.setRowCount(0)
+    table.clearContents()
+    table.setRowCount(len(stocks_data))
+    for i, data in enumerate(stocks_data):
+        color = QColor("#ff4343") if data["ChangeRate"] > 0 else QColor("#07a168")
+        texts = [data["Name"], data["Code"], f'{data["LatestPrice"]:.2f}', f'{data["ChangeRate"]:.2f}%',
+                 f'{data["ChangeAmount"]:.2f}', f'{data["PETTM"]:.1f}', f'{data["PB"]:.1f}',
+                 f'{data["MarketValue"]:.0f}亿']
+        for j, text in enumerate(texts):
+            item = QTableWidgetItem(text)
+            item.setForeground(color)
+            table.setItem(i, j, item)
+
+
+def get_app():
+    """create the QApplication once, run offscreen when there is no display"""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication(sys.argv)
+
+
+def bench_stock_model(ticks=20):
+    """repaint cost per tick of the watchlist table: QTableWidget rebuild vs StockQuoteModel"""
+    app = get_app()
+    from PyQt6.QtWidgets import QTableWidget, QTableView
+    from models import StockQuoteModel
+
+    print("rows     rebuild(ms/tick)   model(ms/tick)")
+    for count in (50, 500, 5000):
+        stocks_data = make_quotes(count)
+        ticks_data = [stocks_data]
+        for _ in range(ticks):
+            ticks_data.append(tick_quotes(ticks_data[-1]))
+
+        table = QTableWidget()
+        table.setColumnCount(8)
+        table.resize(1200, 800)
+        table.show()
+        start = time.perf_counter()
+        for data in ticks_data:
+            rebuild_table_widget(table, data)
+            table.viewport().repaint()
+            app.processEvents()
+        rebuild_ms = (time.perf_counter() - start) * 1000 / len(ticks_data)
+        table.close()
+
+        model = StockQuoteModel([data["Code"] for data in stocks_data])
+        view = QTableView()
+        view.setModel(model)
+        view.resize(1200, 800)
+        view.show()
+        start = time.perf_counter()
+        for data in ticks_data:
+            model.update_quotes(data)
+            view.viewport().repaint()
+            app.processEvents()
+        model_ms = (time.perf_counter() - start) * 1000 / len(ticks_data)
+        view.close()
+
+        print(f"{count:<8} {rebuild_ms:<18.2f} {model_ms:.2f}")
+
+
+def make_announcements(count, start=0):
+    """generate fake announcement dicts in the format of stockapi"""
+    return [{
+        "AnnouncementId": str(start + i),
+        "Code": f"{i % 5000:06d}",
+        "Name": f"股票{i % 5000}",
+        "AnnouncementTitle": f"关于第{i}号事项的公告",
+        "AnnouncementDate": f"20{i % 20 + 2:02d}-{i % 12 + 1:02d}-{i % 28 + 1:02d}",
+        "AnnouncementUrl": f"http://static.cninfo.com.cn/finalpage/2022-05-26/{start + i}.PDF"}
+        for i in range(count)]
+
+
+def bench_bulk_insert(count=10000):
+    """per-row insert_announcement vs insert_announcements_bulk on a fresh database"""
+    import createdb
+    from PyQt6.QtCore import QCoreApplication
+
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    announcements = make_announcements(count)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = createdb.AnnouncementDatabase(os.path.join(directory, "per_row.db"))
+        start = time.perf_counter()
+        for row in map(createdb.announcement_values, announcements):
+            db.insert_announcement(*row).result()
+        per_row = time.perf_counter() - start
+        db.close()
+
+        db = createdb.AnnouncementDatabase(os.path.join(directory, "bulk.db"))
+        start = time.perf_counter()
+        inserted, ignored = db.insert_announcements_bulk(announcements).result()
+        bulk = time.perf_counter() - start
+        db.close()
+
+    print(f"{count} rows: per-row {per_row:.2f}s, bulk {bulk:.2f}s "
+          f"({per_row / bulk:.0f}x), inserted {inserted}, ignored {ignored}")
+
+
+def bench_announcement_page(sizes=(1000, 1000000)):
+    """time to open the announcement list with 1k and 1M announcements in the database"""
+    app = get_app()
+    from PyQt6.QtWidgets import QTableView
+    import createdb
+    from models import AnnouncementTableModel
+
+    with tempfile.TemporaryDirectory() as directory:
+        for count in sizes:
+            db = createdb.AnnouncementDatabase(os.path.join(directory, f"{count}.db"))
+            for start in range(0, count, 100000):
+                db.insert_announcements_bulk(make_announcements(min(100000, count - start), start)).result()
+
+            start = time.perf_counter()
+            model = AnnouncementTableModel(db.query_announcements_page, createdb.ANNOUNCEMENT_PAGE_SIZE)
+            view = QTableView()
+            view.setModel(model)
+            view.resize(1200, 800)
+            view.show()
+            view.viewport().repaint()
+            app.processEvents()
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"{count} announcements: opened in {elapsed:.1f} ms, {model.rowCount()} rows loaded")
+
+            # 滚动到底部，触发读取下一页
+            start = time.perf_counter()
+            view.scrollToBottom()
+            app.processEvents()
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"{count} announcements: next page in {elapsed:.1f} ms, {model.rowCount()} rows loaded")
+            view.close()
+            db.close()
+
+
+def bench_search(count=3000000, queries=("第12345号", "第123", "事项的公告", "公告", "股票")):
+    """full text search of announcement titles with millions of announcements in the database"""
+    import createdb
+    from PyQt6.QtCore import QCoreApplication
+
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as directory:
+        db = createdb.AnnouncementDatabase(os.path.join(directory, "search.db"))
+        start = time.perf_counter()
+        for offset in range(0, count, 100000):
+            db.insert_announcements_bulk(make_announcements(min(100000, count - offset), offset)).result()
+        print(f"{count} announcements inserted and indexed in {time.perf_counter() - start:.1f}s")
+
+        for text in queries:
+            start = time.perf_counter()
+            results = db.search_announcements(text)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"search {text!r}: {len(results)} results in {elapsed:.1f} ms")
+        db.close()
+
+
+def make_study_reports(count):
+    """generate fake study report dicts in the format of stockapi"""
+    def forecast(i):
+        # 约 10% 的预测缺失，接口返回 ""
+        return "" if i % 10 == 0 else round(i % 997 / 100, 2)
+
+    return [{
+        "infoCode": f"AP{i:012d}",
+        "title": f"第{i}篇研究报告",
+        "stockCode": f"{i % 5000:06d}",
+        "stockName": f"股票{i % 5000}",
+        "orgSName": f"券商{i % 60}",
+        "publishDate": f"20{i % 10 + 15:02d}-{i % 12 + 1:02d}-{i % 28 + 1:02d} 00:00:00.000",
+        "predictNextTwoYearEps": forecast(i),
+        "predictNextTwoYearPe": forecast(i + 1),
+        "predictNextYearEps": forecast(i + 2),
+        "predictNextYearPe": forecast(i + 3),
+        "predictThisYearEps": forecast(i + 4),
+        "predictThisYearPe": forecast(i + 5),
+        "predictLastYearEps": forecast(i + 6),
+        "predictLastYearPe": forecast(i + 7),
+        "indvInduName": f"行业{i % 30}",
+        "emRatingValue": str(i % 3 + 1),
+        "emRatingName": "买入",
+        "lastEmRatingValue": str((i + 1) % 3 + 1),
+        "lastEmRatingName": "增持",
+        "author": [f"1.作者{i % 100}"],
+        "pdfUrl": f"https://pdf.dfcfw.com/pdf/H3_AP{i:012d}_1.pdf"}
+        for i in range(count)]
+
+
+def read_study_report_strings(query):
+    """the dict of strings that query_study_reports returned before the typed records"""
+    keys = ["InfoCode", "Title", "StockCode", "StockName", "OrgShortName", "PublishDate",
+            "PredictNextTwoYearsEps", "PredictNextTwoYearsPe", "PredictNextYearEps", "PredictNextYearPe",
+            "PredictThisYearEps", "PredictThisYearPe", "PredictLastYearEps", "PredictLastYearPe",
+            "IndustryName", "EmRatingValue", "EmRatingName", "LastRatingValue", "LastRatingName",
+            "Authors", "PdfUrl"]
+    return {key: str(query.value(i)) for i, key in enumerate(keys)}
+
+
+def bench_query_records(count=100000):
+    """time and memory of reading study reports as dicts of strings, typed records and numpy columns"""
+    import tracemalloc
+    import createdb
+    from PyQt6.QtCore import QCoreApplication
+
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as directory:
+        db = createdb.AnnouncementDatabase(os.path.join(directory, "reports.db"))
+        db.insert_study_reports_bulk(make_study_reports(count)).result()
+
+        def dict_of_strings():
+            query = db.query
+            query.exec(f"SELECT {', '.join(createdb.STUDY_REPORT_COLUMNS)} FROM study_reports "
+                       "ORDER BY publish_date DESC;")
+            reports = []
+            while query.next():
+                reports.append(read_study_report_strings(query))
+            return reports
+
+        for name, read in [("dict of strings", dict_of_strings),
+                           ("typed records", db.query_study_reports),
+                           ("numpy columns", db.query_study_report_columns)]:
+            read()
+            start = time.perf_counter()
+            read()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            result = read()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del result
+            print(f"{name}: {count} rows in {elapsed:.2f}s, {size / count:.0f} bytes/row")
+        db.close()
+
+
+def bench_ratios(stocks=5000, quarters=80):
+    """compute all financial ratios of a synthetic (stock x quarter x item) panel"""
+    import numpy as np
+    import ratios
+
+    rng = np.random.default_rng(0)
+    names = list(ratios.ITEMS)
+    values = rng.uniform(1, 1000, (stocks, quarters, len(names)))
+    # 约 5% 的数据缺失
+    values[rng.random(values.shape) < 0.05] = np.nan
+    first = ratios.quarter_number("2002-03-31")
+    periods = [ratios.quarter_period(first + i) for i in range(quarters)]
+    panel = ratios.Panel([f"{i:06d}" for i in range(stocks)], periods, names, values)
+
+    start = time.perf_counter()
+    results = ratios.compute_ratios(panel)
+    elapsed = time.perf_counter() - start
+    print(f"{len(results)} ratios of {stocks} stocks x {quarters} quarters in {elapsed:.2f}s")
+
+
+BENCHMARKS = {
+    "stock_model": bench_stock_model,
+    "bulk_insert": bench_bulk_insert,
+    "announcement_page": bench_announcement_page,
+    "search": bench_search,
+    "query_records": bench_query_records,
+    "ratios": bench_ratios,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
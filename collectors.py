@@ -0,0 +1,160 @@
+"""
+collectors.py
+从网站抓取数据并写入数据库，不依赖界面，可以在任何线程中运行
+"""
+import datetime
+import concurrent.futures
+import stockapi
+import httpclient
+from createdb import announcement_key
+
+
+# stockapi.get_latest_announcement2 请求的域名，用于限速
+ANNOUNCEMENT_API_DOMAIN = "www.cninfo.com.cn"
+# 同时抓取公告的股票数量
+ANNOUNCEMENT_MAX_WORKERS = 8
+# 增量同步时第一次请求的公告数量，没有遇到已知公告时加倍，直到 BACKFILL_SIZE
+INCREMENTAL_PAGE_SIZE = 5
+# 新加入自选的股票第一次同步时请求的公告数量
+BACKFILL_SIZE = 100
+
+# 东方财富的个股研报列表接口，按发布时间从新到旧分页
+STUDY_REPORT_LIST_URL = "https://reportapi.eastmoney.com/report/list"
+STUDY_REPORT_PDF_URL = "https://pdf.dfcfw.com/pdf/H3_{}_1.pdf"
+STUDY_REPORT_PAGE_SIZE = 50
+# 第一次抓取一只股票时读取最近几年的研报
+STUDY_REPORT_YEARS = 2
+# 同时抓取研报的股票数量
+STUDY_REPORT_MAX_WORKERS = 8
+
+
+def fetch_announcements(code, size=1):
+    """fetch the latest announcements of a stock, respect the rate limit of the domain"""
+    httpclient.limiter.acquire(ANNOUNCEMENT_API_DOMAIN)
+    return stockapi.get_latest_announcement2(code, size=size)
+
+
+def fetch_new_announcements(code, watermark, known_ids, backfill=False):
+    """
+    fetch the announcements of a stock whose ann_id is not in known_ids.
+
+    stockapi 只支持按数量请求最新的公告，所以“翻页”是把请求的数量加倍，
+    一旦返回的公告中出现不比 watermark (ann_date, ann_id) 新的公告就停止。
+    同一天 ann_id 较小或者被巨潮延迟收录的公告可能排在 watermark 之前，
+    所以是否入库按已经入库的 ann_id 判断，watermark 只用于决定何时停止。
+    backfill 为 True 时一次请求 BACKFILL_SIZE 条，用于新加入自选的股票。
+    """
+    size = BACKFILL_SIZE if backfill else INCREMENTAL_PAGE_SIZE
+    while True:
+        announcements = fetch_announcements(code, size=size)
+        new_announcements = [ann for ann in announcements if int(ann["AnnouncementId"]) not in known_ids]
+        reached_known = watermark is not None and any(
+            announcement_key(ann) <= watermark for ann in announcements)
+
+        if reached_known or len(announcements) < size or size >= BACKFILL_SIZE:
+            return new_announcements
+        size = min(size * 2, BACKFILL_SIZE)
+
+
+def collect_announcements(db, codes, max_workers=ANNOUNCEMENT_MAX_WORKERS, on_stock_done=None):
+    """
+    fetch the announcements of codes published after the last sync in a
+    thread pool. stocks never synced are backfilled once. as soon as a stock
+    finishes, its new announcements are inserted, its watermark is moved and
+    on_stock_done(code, rows) is called with the new rows in the database.
+    return the number of inserted announcements
+    """
+    sync_state = db.query_sync_state()
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for code in codes:
+            future = executor.submit(fetch_new_announcements, code, sync_state.get(code),
+                                     db.query_announcement_ids(code), backfill=code not in sync_state)
+            futures[future] = code
+
+        for future in concurrent.futures.as_completed(futures):
+            code = futures[future]
+            try:
+                announcements = future.result()
+            except Exception as e:
+                print(f"Some exception occured when fetching announcements of {code}: ", e)
+                continue
+
+            if not announcements and code in sync_state:
+                # 没有新公告，不需要写数据库
+                continue
+            inserted, _ = db.sync_announcements(code, announcements).result()
+            total += inserted
+            if inserted > 0 and on_stock_done is not None:
+                ann_ids = [ann["AnnouncementId"] for ann in announcements]
+                on_stock_done(code, db.query_announcements_by_ids(ann_ids))
+    return total
+
+
+def fetch_study_report_page(code, page, today=None):
+    """
+    fetch one page of the study reports of a stock, newest first, in the
+    format of stockapi.get_study_reports. return (reports, number of pages)
+    """
+    today = today or datetime.date.today()
+    params = {
+        "industryCode": "*",
+        "pageSize": STUDY_REPORT_PAGE_SIZE,
+        "industry": "*",
+        "rating": "",
+        "ratingChange": "",
+        "beginTime": (today - datetime.timedelta(days=365 * STUDY_REPORT_YEARS)).isoformat(),
+        "endTime": today.isoformat(),
+        "pageNo": page,
+        "fields": "",
+        "qType": 0,
+        "orgCode": "",
+        "code": code,
+        "rcode": ""}
+    response = httpclient.get(STUDY_REPORT_LIST_URL, params=params)
+    response.raise_for_status()
+    data = response.json()
+    reports = data.get("data") or []
+    for report in reports:
+        report["pdfUrl"] = STUDY_REPORT_PDF_URL.format(report["infoCode"])
+    return reports, data.get("TotalPage") or 1
+
+
+def fetch_new_study_reports(code, known_info_codes):
+    """
+    fetch the study reports of a stock that are not in known_info_codes.
+    报告按发布时间从新到旧排列，遇到第一篇已知的报告就停止翻页
+    """
+    new_reports = []
+    page = 1
+    while True:
+        reports, pages = fetch_study_report_page(code, page)
+        for report in reports:
+            if report["infoCode"] in known_info_codes:
+                return new_reports
+            new_reports.append(report)
+        if not reports or page >= pages:
+            return new_reports
+        page += 1
+
+
+def collect_study_reports(db, codes, max_workers=STUDY_REPORT_MAX_WORKERS):
+    """
+    fetch the new study reports of codes in a thread pool and insert all of
+    them in one transaction. return the rowids of the inserted reports
+    """
+    known = db.query_study_report_info_codes(codes)
+    new_reports = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_new_study_reports, code, known.get(code, set())): code
+                   for code in codes}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                new_reports.extend(future.result())
+            except Exception as e:
+                print(f"Some exception occured when fetching study reports of {futures[future]}: ", e)
+
+    if not new_reports:
+        return []
+    return db.insert_new_study_reports(new_reports).result()
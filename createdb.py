@@ -6,30 +6,315 @@ email: lvbj07@gmail.com
 """
 
 import sys
+import json
+import math
+import atexit
+import datetime
+import statistics
+import functools
+import collections
+import queue
+import threading
+import concurrent.futures
+import numpy as np
 from PyQt6.QtSql import QSqlDatabase, QSqlQuery
 import stockapi
+import migrations
+
+
+DATABASE_PATH = "files/announcements.db"
+# 批量插入时每个事务包含的行数
+BULK_BATCH_SIZE = 5000
+# 公告列表每次从数据库读取的行数
+ANNOUNCEMENT_PAGE_SIZE = 200
+# 全文搜索返回的最多结果数
+SEARCH_LIMIT = 200
+# trigram 分词只能匹配至少 3 个字符的词，更短的词用 LIKE 查找
+FTS_MIN_TERM_LENGTH = 3
+# 匹配结果超过这个数量时不计算相关度（bm25 需要读取整个倒排列表），按时间排序
+SEARCH_RANK_CANDIDATES = 2000
+# 批量插入的一批数据至少有这么多行时，暂停插入触发器，插入后一次写入新行的全文索引
+FTS_DEFER_MIN_ROWS = 1000
+# 表 -> (全文索引表, 索引的 rowid 列, 索引的列)
+FTS_TABLES = {
+    "announcements": ("announcements_fts", "ann_id", "title"),
+    "study_reports": ("study_reports_fts", "id", "title, org_name, authors, industry_name"),
+}
+
+# 每个连接打开后执行的设置
+CONNECTION_PRAGMAS = [
+    # WAL 模式下读不阻塞写，写也不阻塞读
+    "PRAGMA journal_mode = WAL;",
+    # WAL 模式下 NORMAL 不会损坏数据库，只在 checkpoint 时 fsync
+    "PRAGMA synchronous = NORMAL;",
+    # 64MB 页缓存
+    "PRAGMA cache_size = -65536;",
+    # 256MB 内存映射
+    "PRAGMA mmap_size = 268435456;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA busy_timeout = 5000;",
+]
+
+INSERT_ANNOUNCEMENT_SQL = """
+    INSERT OR IGNORE INTO announcements (
+        ann_id, code, name, title, ann_date, url, state)
+    VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+
+INSERT_STUDY_REPORT_SQL = """
+    INSERT OR IGNORE INTO study_reports (
+        info_code, title, stock_code, stock_name, org_name, publish_date, 
+        predict_n2y_eps, predict_n2y_pe, predict_ny_eps, predict_ny_pe, 
+        predict_ty_eps, predict_ty_pe, predict_ly_eps, predict_ly_pe, 
+        industry_name, em_rating_value, em_rating_name, last_rating_value, 
+        last_rating_name, authors, url)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+"""
+
+
+ANNOUNCEMENT_COLUMNS = ["ann_id", "code", "name", "title", "ann_date", "url", "state"]
+STUDY_REPORT_COLUMNS = [
+    "info_code", "title", "stock_code", "stock_name", "org_name", "publish_date",
+    "predict_n2y_eps", "predict_n2y_pe", "predict_ny_eps", "predict_ny_pe",
+    "predict_ty_eps", "predict_ty_pe", "predict_ly_eps", "predict_ly_pe",
+    "industry_name", "em_rating_value", "em_rating_name", "last_rating_value",
+    "last_rating_name", "authors", "url"]
+# 研报的数值列，缺失的值是 None
+STUDY_REPORT_NUMBER_COLUMNS = [
+    "predict_n2y_eps", "predict_n2y_pe", "predict_ny_eps", "predict_ny_pe",
+    "predict_ty_eps", "predict_ty_pe", "predict_ly_eps", "predict_ly_pe",
+    "em_rating_value", "last_rating_value"]
+
+# quotes.get_market_data_many 返回的行情字段，与表 quotes 的列一一对应
+QUOTE_KEYS = ["Code", "Name", "LatestPrice", "ChangeRate", "ChangeAmount", "PETTM", "PB", "MarketValue"]
+
+# 查询返回的记录，字段与表的列相同，日期是 datetime.date；
+# snippet 是搜索结果中用【】标出匹配词的摘要
+Announcement = collections.namedtuple("Announcement", ANNOUNCEMENT_COLUMNS + ["snippet"], defaults=[None])
+StudyReport = collections.namedtuple("StudyReport", STUDY_REPORT_COLUMNS + ["snippet"], defaults=[None])
+
+
+def to_number(value):
+    """a number read from the database, NULL and the '' stored for missing values are None"""
+    return value if isinstance(value, (int, float)) else None
+
+
+def to_quote_number(value):
+    """a number of a quote, NULL and values like "-" of suspended stocks are nan"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def to_date(value):
+    """convert a 'YYYY-MM-DD' column to datetime.date, None if it is not a date"""
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def number_or_null(column):
+    """sql of a number column, the '' stored for missing values is NULL"""
+    return f"IIF(typeof({column}) IN ('integer', 'real'), {column}, NULL)"
+
+
+def json_row(columns, alias=None):
+    """
+    sql returning the columns of a row as one JSON array, so a row is read
+    with one QSqlQuery.value call and parsed by json in C
+    """
+    values = []
+    for column in columns:
+        value = f"{alias}.{column}" if alias else column
+        if column in STUDY_REPORT_NUMBER_COLUMNS:
+            value = number_or_null(value)
+        values.append(value)
+    return f"json_array({', '.join(values)})"
+
+
+ANNOUNCEMENT_ROW = json_row(ANNOUNCEMENT_COLUMNS)
+STUDY_REPORT_ROW = json_row(STUDY_REPORT_COLUMNS)
+
+
+def announcement_values(ann, state="UNREAD"):
+    """convert an announcement dict returned by stockapi to a row of table announcements"""
+    return (int(ann["AnnouncementId"]), ann["Code"], ann["Name"], ann["AnnouncementTitle"],
+            ann["AnnouncementDate"], ann["AnnouncementUrl"], state)
+
+
+def announcement_key(ann):
+    """the (ann_date, ann_id) sort key of an announcement dict"""
+    return (ann["AnnouncementDate"], int(ann["AnnouncementId"]))
+
+
+def study_report_values(report_obj):
+    """convert a study report dict returned by stockapi to a row of table study_reports"""
+    authors = ",".join([author.split(".")[1] for author in report_obj["author"]])
+    return (
+        report_obj["infoCode"],
+        report_obj["title"],
+        report_obj["stockCode"],
+        report_obj["stockName"],
+        report_obj["orgSName"],
+        report_obj["publishDate"].split()[0],
+        report_obj["predictNextTwoYearEps"],
+        report_obj["predictNextTwoYearPe"],
+        report_obj["predictNextYearEps"],
+        report_obj["predictNextYearPe"],
+        report_obj["predictThisYearEps"],
+        report_obj["predictThisYearPe"],
+        report_obj["predictLastYearEps"],
+        report_obj["predictLastYearPe"],
+        report_obj["indvInduName"],
+        report_obj["emRatingValue"],
+        report_obj["emRatingName"],
+        report_obj["lastEmRatingValue"],
+        report_obj["lastEmRatingName"],
+        authors,
+        report_obj["pdfUrl"])
+
+
+def fts_query(text):
+    """
+    convert the words typed in a search box to an FTS5 query: every word
+    is a quoted phrase and all words must match. return None if a word
+    is too short for the trigram index
+    """
+    terms = text.split()
+    if not terms or any(len(term) < FTS_MIN_TERM_LENGTH for term in terms):
+        return None
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def like_pattern(term):
+    """the LIKE pattern matching term anywhere, use it with ESCAPE '\\'"""
+    term = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{term}%"
+
+
+def write_operation(method):
+    """
+    写操作都交给 DatabaseWriter 线程在它自己的连接上执行，
+    被装饰的方法返回 concurrent.futures.Future，需要结果时调用 result()
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.writer.submit(method, self, *args, **kwargs)
+    return wrapper
+
+
+class DatabaseWriter(threading.Thread):
+    """
+    the only thread that writes to the database, write operations
+    are queued and executed one by one
+    """
+    def __init__(self):
+        super().__init__(name="DatabaseWriter", daemon=True)
+        self.jobs = queue.Queue()
+
+    def submit(self, func, *args, **kwargs):
+        """queue func(*args, **kwargs), return a Future of its result"""
+        future = concurrent.futures.Future()
+        if threading.current_thread() is self:
+            # 写操作中调用了其它写操作，直接执行，避免等待自己
+            self.execute(future, func, args, kwargs)
+        else:
+            self.jobs.put((future, func, args, kwargs))
+        return future
+
+    @staticmethod
+    def execute(future, func, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            print("Some exception occured in DatabaseWriter: ", e)
+            future.set_exception(e)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            self.execute(*job)
+
+    def stop(self):
+        """finish the queued jobs and stop the thread"""
+        if self.is_alive():
+            self.jobs.put(None)
+            self.join()
 
 
 class AnnouncementDatabase:
     """
     create announcements database 
+
+    每个线程使用自己的连接读取数据库，所有写操作都在 DatabaseWriter 线程中执行。
     """
-    def __init__(self):
+    def __init__(self, path=DATABASE_PATH):
         super().__init__()
 
+        self.path = path
+        self.local = threading.local()
         self.create_connection()
         self.create_announcements_table()
         self.create_stock_table()
         self.create_study_report_table()
+        migrations.migrate(self.database)
+
+        self.writer = DatabaseWriter()
+        self.writer.start()
+        atexit.register(self.close)
 
     def create_connection(self):
-        """create connection to the database."""
-        database = QSqlDatabase.addDatabase("QSQLITE") 
-        database.setDatabaseName("files/announcements.db")
+        """create connection to the database for the current thread."""
+        name = f"announcements-{id(self)}-{threading.get_ident()}"
+        database = QSqlDatabase.addDatabase("QSQLITE", name)
+        database.setDatabaseName(self.path)
         if not database.open():
             print("Unable to open data source file.")
             sys.exit(1)
-        self.query = QSqlQuery()
+        query = QSqlQuery(database)
+        for pragma in CONNECTION_PRAGMAS:
+            query.exec(pragma)
+        # 结果只按顺序读取一遍，不需要在 Qt 中缓存已经读过的行
+        query.setForwardOnly(True)
+        self.local.name = name
+        self.local.database = database
+        self.local.query = query
+
+    @property
+    def database(self):
+        """the connection of the current thread"""
+        if not hasattr(self.local, "database"):
+            self.create_connection()
+        return self.local.database
+
+    @property
+    def query(self):
+        """the query of the current thread"""
+        if not hasattr(self.local, "query"):
+            self.create_connection()
+        return self.local.query
+
+    def close_thread_connection(self):
+        """close the connection of the current thread, call it before a worker thread exits"""
+        if not hasattr(self.local, "name"):
+            return
+        name = self.local.name
+        self.local.query.finish()
+        self.local.database.close()
+        del self.local.query
+        del self.local.database
+        del self.local.name
+        QSqlDatabase.removeDatabase(name)
+
+    def close(self):
+        """finish the queued writes and stop the writer thread"""
+        self.writer.stop()
 
     def create_announcements_table(self):
         """
@@ -60,7 +345,8 @@ class AnnouncementDatabase:
         """
         self.query.exec("""
             CREATE TABLE IF NOT EXISTS study_reports (
-                info_code VARCHAR(20) PRIMARY KEY UNIQUE NOT NULL,
+                id INTEGER PRIMARY KEY,
+                info_code VARCHAR(20) UNIQUE NOT NULL,
                 title NTEXT NOT NULL,
                 stock_code VARCHAR(6) NOT NULL,
                 stock_name NVARCHAR(10) NOT NULL,
@@ -79,15 +365,15 @@ class AnnouncementDatabase:
                 em_rating_name NVARCHAR(10),
                 last_rating_value INT,
                 last_rating_name NVARCHAR(10),
-                authors NTEXT);""")
+                authors NTEXT,
+                url NTEXT);""")
 
+    @write_operation
     def insert_announcement(self, ann_id, code, name, title, ann_date, url, state, reverse=True):
         """
         insert an announcement record to table
         """
-        self.query.prepare("""INSERT OR IGNORE INTO announcements (
-            ann_id, code, name, title, ann_date, url, state)
-            VALUES (?, ?, ?, ?, ?, ?, ?);""")
+        self.query.prepare(INSERT_ANNOUNCEMENT_SQL)
 
         self.query.addBindValue(ann_id)
         self.query.addBindValue(code)
@@ -98,6 +384,7 @@ class AnnouncementDatabase:
         self.query.addBindValue(state)
         self.query.exec()
 
+    @write_operation
     def insert_stock(self, code, name, category):
         """insert a stock record to table"""
 
@@ -112,84 +399,203 @@ class AnnouncementDatabase:
         self.query.addBindValue(category)
         self.query.exec()
 
+    @write_operation
     def insert_study_report(self, report_obj: dict):
         """
         insert a study report to table
         """
-        sql = """
-            INSERT OR IGNORE INTO study_reports (
-                info_code, title, stock_code, stock_name, org_name, publish_date, 
-                predict_n2y_eps, predict_n2y_pe, predict_ny_eps, predict_ny_pe, 
-                predict_ty_eps, predict_ty_pe, predict_ly_eps, predict_ly_pe, 
-                industry_name, em_rating_value, em_rating_name, last_rating_value, 
-                last_rating_name, authors, url)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-        """
-        self.query.prepare(sql)
-        self.query.addBindValue(report_obj["infoCode"])
-        self.query.addBindValue(report_obj["title"])
-        self.query.addBindValue(report_obj["stockCode"])
-        self.query.addBindValue(report_obj["stockName"])
-        self.query.addBindValue(report_obj["orgSName"])
-        self.query.addBindValue(report_obj["publishDate"].split()[0])
-        self.query.addBindValue(report_obj["predictNextTwoYearEps"])
-        self.query.addBindValue(report_obj["predictNextTwoYearPe"])
-        self.query.addBindValue(report_obj["predictNextYearEps"])
-        self.query.addBindValue(report_obj["predictNextYearPe"])
-        self.query.addBindValue(report_obj["predictThisYearEps"])
-        self.query.addBindValue(report_obj["predictThisYearPe"])
-        self.query.addBindValue(report_obj["predictLastYearEps"])
-        self.query.addBindValue(report_obj["predictLastYearPe"])
-        self.query.addBindValue(report_obj["indvInduName"])
-        self.query.addBindValue(report_obj["emRatingValue"])
-        self.query.addBindValue(report_obj["emRatingName"])
-        self.query.addBindValue(report_obj["lastEmRatingValue"])
-        self.query.addBindValue(report_obj["lastEmRatingName"])
-        authors = ",".join([author.split(".")[1] for author in report_obj["author"]])
-        self.query.addBindValue(authors)
-        self.query.addBindValue(report_obj["pdfUrl"])
+        self.query.prepare(INSERT_STUDY_REPORT_SQL)
+        for value in study_report_values(report_obj):
+            self.query.addBindValue(value)
         self.query.exec()
 
+    def insert_bulk(self, sql, rows, table, key):
+        """
+        insert rows with one prepared statement. rows are bound in batches of
+        BULK_BATCH_SIZE and every batch runs in one transaction. the first
+        value of every row is the primary key column key of table.
+        return (inserted, ignored)
+        """
+        inserted = 0
+        total = 0
+        rows = list(rows)
+        for start in range(0, len(rows), BULK_BATCH_SIZE):
+            batch = rows[start:start + BULK_BATCH_SIZE]
+            self.database.transaction()
+            # total_changes() 包含触发器写入全文索引等表的行，所以用已经存在的主键计算插入的行数
+            keys = list({row[0] for row in batch})
+            new_keys = list(set(keys) - self.existing_keys(table, key, keys))
+            defer_fts = table in FTS_TABLES and len(new_keys) >= FTS_DEFER_MIN_ROWS
+            if defer_fts:
+                self.query.exec(f"INSERT OR IGNORE INTO fts_deferred (name) VALUES ('{table}');")
+            self.query.prepare(sql)
+            # 按列绑定整批数据
+            for column in zip(*batch):
+                self.query.addBindValue(list(column))
+            ok = self.query.execBatch()
+            if ok and defer_fts:
+                ok = self.index_new_rows(table, key, new_keys)
+                ok = self.query.exec(f"DELETE FROM fts_deferred WHERE name = '{table}';") and ok
+            if not ok:
+                print("Bulk insert failed: ", self.query.lastError().text())
+                self.database.rollback()
+                continue
+            self.database.commit()
+            inserted += len(new_keys)
+            total += len(batch)
+        return inserted, total - inserted
+
+    def existing_keys(self, table, key, keys):
+        """the keys already in the primary key column key of table"""
+        query = QSqlQuery(self.database)
+        query.prepare(f"SELECT {key} FROM {table} WHERE {key} IN (SELECT value FROM json_each(?));")
+        query.addBindValue(json.dumps(keys, ensure_ascii=False))
+        query.exec()
+        existing = set()
+        while query.next():
+            existing.add(query.value(0))
+        return existing
+
+    def index_new_rows(self, table, key, keys):
+        """write the full text index of the rows inserted while the insert trigger was deferred"""
+        fts_table, rowid, columns = FTS_TABLES[table]
+        self.query.prepare(f"""
+            INSERT INTO {fts_table} (rowid, {columns})
+            SELECT {rowid}, {columns} FROM {table}
+            WHERE {key} IN (SELECT value FROM json_each(?));""")
+        self.query.addBindValue(json.dumps(keys, ensure_ascii=False))
+        return self.query.exec()
+
+    @write_operation
+    def insert_announcements_bulk(self, announcements, state="UNREAD"):
+        """
+        insert announcement dicts returned by stockapi in transactions,
+        return a Future of (inserted, ignored)
+        """
+        rows = [announcement_values(ann, state) for ann in announcements]
+        return self.insert_bulk(INSERT_ANNOUNCEMENT_SQL, rows, "announcements", "ann_id")
+
+    @write_operation
+    def insert_study_reports_bulk(self, report_objs):
+        """
+        insert study report dicts returned by stockapi in transactions,
+        return a Future of (inserted, ignored)
+        """
+        rows = [study_report_values(report_obj) for report_obj in report_objs]
+        return self.insert_bulk(INSERT_STUDY_REPORT_SQL, rows, "study_reports", "info_code")
+
     
+    @write_operation
+    def insert_new_study_reports(self, report_objs):
+        """
+        insert study report dicts returned by stockapi in one transaction,
+        return a Future of the rowids (the id column) of the inserted reports
+        """
+        rowids = []
+        self.database.transaction()
+        self.query.prepare(INSERT_STUDY_REPORT_SQL)
+        for report_obj in report_objs:
+            for value in study_report_values(report_obj):
+                self.query.addBindValue(value)
+            if not self.query.exec():
+                print("Unable to insert study report: ", self.query.lastError().text())
+                continue
+            # 已经存在的报告被忽略
+            if self.query.numRowsAffected() > 0:
+                rowids.append(self.query.lastInsertId())
+        self.database.commit()
+        return rowids
+
+    def query_study_report_info_codes(self, codes):
+        """return {stock code: set of the info_code of its study reports}"""
+        info_codes = {}
+        self.query.prepare("""
+            SELECT stock_code, info_code FROM study_reports
+            WHERE stock_code IN (SELECT value FROM json_each(?));""")
+        self.query.addBindValue(json.dumps(list(codes)))
+        self.query.exec()
+        while self.query.next():
+            info_codes.setdefault(self.query.value(0), set()).add(self.query.value(1))
+        return info_codes
+
+    def query_study_reports_by_rowids(self, rowids):
+        """query study reports by rowid, newest first"""
+        self.query.prepare(f"""
+            SELECT {STUDY_REPORT_ROW} FROM study_reports
+            WHERE id IN (SELECT value FROM json_each(?))
+            ORDER BY publish_date DESC;""")
+        self.query.addBindValue(json.dumps([int(rowid) for rowid in rowids]))
+        self.query.exec()
+
+        study_reports = []
+        while self.query.next():
+            study_reports.append(self.read_study_report())
+        return study_reports
+
     def query_study_reports(self, reverse=True):
         """query study reports"""
         study_reports = []
         if reverse:
-            self.query.exec("""
-                SELECT * FROM study_reports
+            self.query.exec(f"""
+                SELECT {STUDY_REPORT_ROW} FROM study_reports
                 ORDER BY publish_date DESC;""")
         else:
-            self.query.exec("""
-                SELECT * FROM study_reports
+            self.query.exec(f"""
+                SELECT {STUDY_REPORT_ROW} FROM study_reports
                 ORDER BY publish_date DESC;""")
 
         while self.query.next():
-            report = {
-                "InfoCode": str(self.query.value(0)),
-                "Title": str(self.query.value(1)),
-                "StockCode": str(self.query.value(2)),
-                "StockName": str(self.query.value(3)),
-                "OrgShortName": str(self.query.value(4)),
-                "PublishDate": str(self.query.value(5)),
-                "PredictNextTwoYearsEps": str(self.query.value(6)),
-                "PredictNextTwoYearsPe": str(self.query.value(7)),
-                "PredictNextYearEps": str(self.query.value(8)),
-                "PredictNextYearPe": str(self.query.value(9)),
-                "PredictThisYearEps": str(self.query.value(10)),
-                "PredictThisYearPe": str(self.query.value(11)),
-                "PredictLastYearEps": str(self.query.value(12)),
-                "PredictLastYearPe": str(self.query.value(13)),
-                "IndustryName": str(self.query.value(14)),
-                "EmRatingValue": str(self.query.value(15)),
-                "EmRatingName": str(self.query.value(16)),
-                "LastRatingValue": str(self.query.value(17)),
-                "LastRatingName": str(self.query.value(18)),
-                "Authors": str(self.query.value(19)),
-                "PdfUrl": str(self.query.value(20))}
-            study_reports.append(report)
+            study_reports.append(self.read_study_report())
         return study_reports
 
+    def read_study_report(self, snippet=False):
+        """
+        convert the current row of self.query, selected with STUDY_REPORT_ROW,
+        to a StudyReport. snippet is in the second column
+        """
+        values = json.loads(self.query.value(0))
+        values[5] = to_date(values[5])
+        return StudyReport(*values, self.query.value(1) if snippet else None)
+
+    def query_study_report_columns(self, columns=STUDY_REPORT_NUMBER_COLUMNS, stock_code=None):
+        """
+        column-oriented query of the study reports, newest first: return
+        {column: values}. number columns are float64 arrays with nan for
+        missing values, publish_date is a datetime64[D] array, the other
+        columns are lists. every column is read as one JSON array built by sqlite,
+        so no value passes through QSqlQuery.value
+        """
+        selects = []
+        for column in columns:
+            if column not in STUDY_REPORT_COLUMNS:
+                raise ValueError(f"unknown column of study_reports: {column}")
+            if column in STUDY_REPORT_NUMBER_COLUMNS:
+                column = number_or_null(column)
+            selects.append(f"json_group_array({column})")
+        where = "WHERE stock_code = ?" if stock_code is not None else ""
+        query = QSqlQuery(self.database)
+        query.prepare(f"""
+            SELECT {", ".join(selects)} FROM (
+                SELECT * FROM study_reports {where}
+                ORDER BY publish_date DESC);""")
+        if stock_code is not None:
+            query.addBindValue(stock_code)
+        query.exec()
+        query.next()
+
+        result = {}
+        for i, column in enumerate(columns):
+            values = json.loads(query.value(i))
+            if column in STUDY_REPORT_NUMBER_COLUMNS:
+                # None 转换为 nan
+                result[column] = np.array(values, dtype=np.float64)
+            elif column == "publish_date":
+                result[column] = np.array(values, dtype="datetime64[D]")
+            else:
+                result[column] = values
+        return result
 
+    @write_operation
     def delete_stock(self, code):
         """delete stock"""
         self.query.exec(f"DELETE FROM stocks WHERE code = '{code}';")
@@ -198,29 +604,532 @@ class AnnouncementDatabase:
         """query announcements"""
         announcements = []
         if reverse:
-            self.query.exec("""
-                SELECT * FROM  announcements
+            self.query.exec(f"""
+                SELECT {ANNOUNCEMENT_ROW} FROM  announcements
                 WHERE state = 'READ' OR state = 'UNREAD' 
                 ORDER BY ann_date DESC;""")
         else:
-            self.query.exec("""
-                SELECT * FROM  announcements
+            self.query.exec(f"""
+                SELECT {ANNOUNCEMENT_ROW} FROM  announcements
                 WHERE state = 'READ' OR state = 'UNREAD' 
                 ORDER BY ann_date;""")
 
         while self.query.next():
-            ann = {
-                "AnnouncementId": str(self.query.value(0)),
-                "Code": str(self.query.value(1)),
-                "Name": str(self.query.value(2)),
-                "AnnouncementTitle": str(self.query.value(3)),
-                "AnnouncementDate": str(self.query.value(4)),
-                "AnnouncementUrl": str(self.query.value(5)),
-                "AnnouncementState": str(self.query.value(6))}
-            announcements.append(ann)
+            announcements.append(self.read_announcement())
 
         return announcements
 
+    def read_announcement(self, snippet=False):
+        """
+        convert the current row of self.query, selected with ANNOUNCEMENT_ROW,
+        to an Announcement. snippet is in the second column
+        """
+        values = json.loads(self.query.value(0))
+        values[4] = to_date(values[4])
+        return Announcement(*values, self.query.value(1) if snippet else None)
+
+    def query_announcements_page(self, after=None, limit=ANNOUNCEMENT_PAGE_SIZE):
+        """
+        query one page of READ/UNREAD announcements, newest first.
+        after is the (ann_date, ann_id) of the last row of the previous page,
+        None for the first page. 按 (ann_date, ann_id) 做 keyset 分页，
+        翻页的代价与已经翻过的页数无关。
+        """
+        if after is None:
+            self.query.prepare(f"""
+                SELECT {ANNOUNCEMENT_ROW} FROM announcements
+                WHERE state IN ('READ', 'UNREAD')
+                ORDER BY ann_date DESC, ann_id DESC
+                LIMIT ?;""")
+        else:
+            self.query.prepare(f"""
+                SELECT {ANNOUNCEMENT_ROW} FROM announcements
+                WHERE (ann_date, ann_id) < (?, ?) AND state IN ('READ', 'UNREAD')
+                ORDER BY ann_date DESC, ann_id DESC
+                LIMIT ?;""")
+            self.query.addBindValue(str(after[0]))
+            self.query.addBindValue(int(after[1]))
+        self.query.addBindValue(limit)
+        self.query.exec()
+
+        announcements = []
+        while self.query.next():
+            announcements.append(self.read_announcement())
+        return announcements
+
+    def query_announcements_by_ids(self, ann_ids):
+        """query READ/UNREAD announcements by ann_id"""
+        ann_ids = [int(ann_id) for ann_id in ann_ids]
+        if not ann_ids:
+            return []
+        placeholders = ", ".join("?" * len(ann_ids))
+        self.query.prepare(f"""
+            SELECT {ANNOUNCEMENT_ROW} FROM announcements
+            WHERE ann_id IN ({placeholders}) AND state IN ('READ', 'UNREAD')
+            ORDER BY ann_date DESC, ann_id DESC;""")
+        for ann_id in ann_ids:
+            self.query.addBindValue(ann_id)
+        self.query.exec()
+
+        announcements = []
+        while self.query.next():
+            announcements.append(self.read_announcement())
+        return announcements
+
+    def fts_match_count_exceeds(self, table, match, count):
+        """check whether more than count rows of an FTS5 table match, without counting all of them"""
+        query = QSqlQuery(self.database)
+        query.prepare(f"SELECT rowid FROM {table} WHERE {table} MATCH ? LIMIT 1 OFFSET ?;")
+        query.addBindValue(match)
+        query.addBindValue(count)
+        query.exec()
+        return query.next()
+
+    def search_announcements(self, text, limit=SEARCH_LIMIT):
+        """
+        full text search of READ/UNREAD announcement titles, ranked by bm25.
+        if more than SEARCH_RANK_CANDIDATES titles match, or a word is shorter
+        than FTS_MIN_TERM_LENGTH, the newest matches are returned first.
+        every Announcement has a snippet with the matched words in 【】
+        """
+        terms = text.split()
+        if not terms:
+            return []
+        match = fts_query(text)
+        if match is not None:
+            if self.fts_match_count_exceeds("announcements_fts", match, SEARCH_RANK_CANDIDATES):
+                order = "announcements_fts.rowid DESC"
+            else:
+                order = "announcements_fts.rank"
+            self.query.prepare(f"""
+                SELECT {json_row(ANNOUNCEMENT_COLUMNS, "a")}, snippet(announcements_fts, 0, '【', '】', '…', 32)
+                FROM announcements_fts JOIN announcements AS a ON a.ann_id = announcements_fts.rowid
+                WHERE announcements_fts MATCH ? AND a.state IN ('READ', 'UNREAD')
+                ORDER BY {order}
+                LIMIT ?;""")
+            self.query.addBindValue(match)
+        else:
+            # 词太短，不能使用 trigram 索引，从最新的公告开始按主键顺序扫描，
+            # +state 避免使用 state 索引后再排序
+            conditions = " AND ".join("title LIKE ? ESCAPE '\\'" for _ in terms)
+            self.query.prepare(f"""
+                SELECT {ANNOUNCEMENT_ROW}, title FROM announcements
+                WHERE +state IN ('READ', 'UNREAD') AND {conditions}
+                ORDER BY ann_id DESC
+                LIMIT ?;""")
+            for term in terms:
+                self.query.addBindValue(like_pattern(term))
+        self.query.addBindValue(limit)
+        self.query.exec()
+
+        announcements = []
+        while self.query.next():
+            announcements.append(self.read_announcement(snippet=True))
+        return announcements
+
+    def search_study_reports(self, text, limit=SEARCH_LIMIT):
+        """
+        full text search of study reports by title, organization, authors
+        and industry, best matches first. matches in the title rank higher
+        """
+        terms = text.split()
+        if not terms:
+            return []
+        match = fts_query(text)
+        if match is not None:
+            if self.fts_match_count_exceeds("study_reports_fts", match, SEARCH_RANK_CANDIDATES):
+                order = "s.publish_date DESC"
+            else:
+                order = "bm25(study_reports_fts, 10.0, 2.0, 2.0, 1.0)"
+            self.query.prepare(f"""
+                SELECT {json_row(STUDY_REPORT_COLUMNS, "s")}, snippet(study_reports_fts, -1, '【', '】', '…', 32)
+                FROM study_reports_fts JOIN study_reports AS s ON s.id = study_reports_fts.rowid
+                WHERE study_reports_fts MATCH ?
+                ORDER BY {order}
+                LIMIT ?;""")
+            self.query.addBindValue(match)
+        else:
+            columns = ["title", "org_name", "authors", "industry_name"]
+            term_condition = "(" + " OR ".join(f"{column} LIKE ? ESCAPE '\\'" for column in columns) + ")"
+            conditions = " AND ".join(term_condition for _ in terms)
+            self.query.prepare(f"""
+                SELECT {STUDY_REPORT_ROW}, title FROM study_reports
+                WHERE {conditions}
+                ORDER BY publish_date DESC
+                LIMIT ?;""")
+            for term in terms:
+                for _ in columns:
+                    self.query.addBindValue(like_pattern(term))
+        self.query.addBindValue(limit)
+        self.query.exec()
+
+        study_reports = []
+        while self.query.next():
+            study_reports.append(self.read_study_report(snippet=True))
+        return study_reports
+
+    def query_sync_state(self):
+        """
+        return a dict code -> (last_ann_date, last_ann_id) of the newest
+        announcement already ingested, the watermark is None if the stock
+        has been synced but has no announcements. stocks never synced are missing.
+        """
+        sync_state = {}
+        self.query.exec("SELECT code, last_ann_date, last_ann_id FROM announcement_sync_state;")
+        while self.query.next():
+            if self.query.isNull(2):
+                sync_state[self.query.value(0)] = None
+            else:
+                sync_state[self.query.value(0)] = (self.query.value(1), self.query.value(2))
+        return sync_state
+
+    def query_announcement_ids(self, code):
+        """return the set of ann_id of the announcements of a stock already ingested"""
+        ann_ids = set()
+        self.query.prepare("SELECT ann_id FROM announcements WHERE code = ?;")
+        self.query.addBindValue(code)
+        self.query.exec()
+        while self.query.next():
+            ann_ids.add(self.query.value(0))
+        return ann_ids
+
+    @write_operation
+    def sync_announcements(self, code, announcements, state="UNREAD"):
+        """
+        insert the new announcements of a stock and move its watermark
+        to the newest one, return a Future of (inserted, ignored).
+        延迟收录的旧公告不会让 watermark 后退
+        """
+        inserted, ignored = self.insert_bulk(
+            INSERT_ANNOUNCEMENT_SQL, [announcement_values(ann, state) for ann in announcements],
+            "announcements", "ann_id")
+
+        self.query.prepare("""
+            INSERT INTO announcement_sync_state (code, last_ann_date, last_ann_id, synced_at)
+            VALUES (?, ?, ?, datetime('now', 'localtime'))
+            ON CONFLICT (code) DO UPDATE SET
+                last_ann_date = CASE WHEN last_ann_id IS NULL
+                    OR (excluded.last_ann_date, excluded.last_ann_id) > (last_ann_date, last_ann_id)
+                    THEN excluded.last_ann_date ELSE last_ann_date END,
+                last_ann_id = CASE WHEN last_ann_id IS NULL
+                    OR (excluded.last_ann_date, excluded.last_ann_id) > (last_ann_date, last_ann_id)
+                    THEN excluded.last_ann_id ELSE last_ann_id END,
+                synced_at = excluded.synced_at;""")
+        newest = max(announcements, key=announcement_key, default=None)
+        self.query.addBindValue(code)
+        self.query.addBindValue(None if newest is None else newest["AnnouncementDate"])
+        self.query.addBindValue(None if newest is None else int(newest["AnnouncementId"]))
+        self.query.exec()
+        return inserted, ignored
+
+    def query_document(self, doc_key):
+        """return the manifest record of a document, None if it is not in the store"""
+        self.query.prepare("SELECT doc_key, url, hash, size, fetched_at FROM documents WHERE doc_key = ?;")
+        self.query.addBindValue(doc_key)
+        self.query.exec()
+        if not self.query.next():
+            return None
+        return {
+            "DocKey": self.query.value(0),
+            "Url": self.query.value(1),
+            "Hash": self.query.value(2),
+            "Size": self.query.value(3),
+            "FetchedAt": self.query.value(4)}
+
+    def query_document_usage(self):
+        """
+        return [(hash, size)] of all stored files, least recently used first.
+        内容相同的多条记录共用一个文件，按其中最近一次访问的时间排序
+        """
+        usage = []
+        self.query.exec("""
+            SELECT hash, MAX(size), MAX(accessed_at) AS last_access FROM documents
+            GROUP BY hash
+            ORDER BY last_access;""")
+        while self.query.next():
+            usage.append((self.query.value(0), self.query.value(1)))
+        return usage
+
+    @write_operation
+    def insert_document(self, doc_key, url, hash, size):
+        """add a fetched document to the manifest, replace the old record of doc_key"""
+        self.query.prepare("""
+            INSERT OR REPLACE INTO documents (doc_key, url, hash, size, fetched_at, accessed_at)
+            VALUES (?, ?, ?, ?, datetime('now', 'localtime'),
+                    strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'));""")
+        self.query.addBindValue(doc_key)
+        self.query.addBindValue(url)
+        self.query.addBindValue(hash)
+        self.query.addBindValue(size)
+        self.query.exec()
+
+    @write_operation
+    def touch_documents(self, accessed):
+        """update the access times {doc_key: accessed_at} of documents, used by the LRU eviction"""
+        self.query.prepare("UPDATE documents SET accessed_at = ? WHERE doc_key = ?;")
+        self.query.addBindValue(list(accessed.values()))
+        self.query.addBindValue(list(accessed.keys()))
+        self.database.transaction()
+        self.query.execBatch()
+        self.database.commit()
+
+    @write_operation
+    def delete_documents(self, hashes):
+        """
+        remove all manifest records of stored files and their page text,
+        so the full text search does not return pages of deleted files
+        """
+        self.database.transaction()
+        for table in ["documents", "document_pages", "document_text"]:
+            self.query.prepare(f"DELETE FROM {table} WHERE hash IN (SELECT value FROM json_each(?));")
+            self.query.addBindValue(json.dumps(hashes))
+            self.query.exec()
+        self.database.commit()
+
+    def query_unindexed_documents(self):
+        """return [(hash, size)] of the stored files whose text has not been extracted"""
+        documents = []
+        self.query.exec("""
+            SELECT hash, MAX(size) FROM documents
+            WHERE hash NOT IN (SELECT hash FROM document_text)
+            GROUP BY hash;""")
+        while self.query.next():
+            documents.append((self.query.value(0), self.query.value(1)))
+        return documents
+
+    @write_operation
+    def insert_document_pages(self, hash, size, pages, error=None):
+        """
+        replace the page text of a stored file and mark it as extracted,
+        in one transaction. error is the reason if the text can not be extracted
+        """
+        self.database.transaction()
+        self.query.prepare("DELETE FROM document_pages WHERE hash = ?;")
+        self.query.addBindValue(hash)
+        self.query.exec()
+
+        if pages:
+            self.query.prepare("INSERT INTO document_pages (hash, page, text) VALUES (?, ?, ?);")
+            self.query.addBindValue([hash] * len(pages))
+            self.query.addBindValue(list(range(1, len(pages) + 1)))
+            self.query.addBindValue(list(pages))
+            if not self.query.execBatch():
+                print("Unable to insert document pages: ", self.query.lastError().text())
+                self.database.rollback()
+                return
+
+        self.query.prepare("""
+            INSERT OR REPLACE INTO document_text (hash, size, pages, error, extracted_at)
+            VALUES (?, ?, ?, ?, datetime('now', 'localtime'));""")
+        self.query.addBindValue(hash)
+        self.query.addBindValue(size)
+        self.query.addBindValue(len(pages))
+        self.query.addBindValue(error)
+        self.query.exec()
+        self.database.commit()
+
+    def search_document_pages(self, text, limit=SEARCH_LIMIT):
+        """
+        full text search of the pages of the stored pdf files, return dicts of
+        the document key and url, page number (from 1) and a Snippet
+        """
+        match = fts_query(text)
+        if match is None:
+            # 页面文本很长，不做 LIKE 全表扫描
+            return []
+        if self.fts_match_count_exceeds("document_pages_fts", match, SEARCH_RANK_CANDIDATES):
+            order = "document_pages_fts.rowid DESC"
+        else:
+            order = "document_pages_fts.rank"
+        self.query.prepare(f"""
+            SELECT d.doc_key, d.url, p.hash, p.page, snippet(document_pages_fts, 0, '【', '】', '…', 32)
+            FROM document_pages_fts
+            JOIN document_pages AS p ON p.id = document_pages_fts.rowid
+            JOIN documents AS d ON d.doc_key = (
+                SELECT MIN(doc_key) FROM documents WHERE hash = p.hash)
+            WHERE document_pages_fts MATCH ?
+            ORDER BY {order}
+            LIMIT ?;""")
+        self.query.addBindValue(match)
+        self.query.addBindValue(limit)
+        self.query.exec()
+
+        pages = []
+        while self.query.next():
+            pages.append({
+                "DocKey": self.query.value(0),
+                "Url": self.query.value(1),
+                "Hash": self.query.value(2),
+                "Page": self.query.value(3),
+                "Snippet": self.query.value(4)})
+        return pages
+
+    def consensus_stocks_to_refresh(self):
+        """codes of the stocks whose consensus has to be recomputed"""
+        codes = []
+        self.query.exec("""
+            SELECT stock_code FROM report_consensus WHERE dirty = 1
+            UNION
+            SELECT stock_code FROM eps_consensus WHERE dirty = 1;""")
+        while self.query.next():
+            codes.append(self.query.value(0))
+        return codes
+
+    def recompute_consensus(self, code):
+        """recompute both consensus tables of a stock from its study reports"""
+        eps_columns = ", ".join(f"{eps}, {pe}" for eps, pe in migrations.FORECAST_COLUMNS.values())
+        self.query.prepare(f"""
+            SELECT stock_name, org_name, publish_date, em_rating_value, last_rating_value, {eps_columns}
+            FROM study_reports WHERE stock_code = ?
+            ORDER BY publish_date;""")
+        self.query.addBindValue(code)
+        self.query.exec()
+
+        reports = upgrades = downgrades = 0
+        brokers = set()
+        stock_name = first_date = last_date = None
+        # year -> ([eps], [pe])
+        forecasts = {}
+        while self.query.next():
+            stock_name = self.query.value(0)
+            brokers.add(self.query.value(1))
+            publish_date = self.query.value(2)
+            first_date = first_date or publish_date
+            last_date = publish_date
+            reports += 1
+            rating, last_rating = to_number(self.query.value(3)), to_number(self.query.value(4))
+            if rating is not None and last_rating is not None:
+                upgrades += rating > last_rating
+                downgrades += rating < last_rating
+            for i, offset in enumerate(migrations.FORECAST_COLUMNS):
+                eps, pe = to_number(self.query.value(5 + 2 * i)), to_number(self.query.value(6 + 2 * i))
+                if eps is None:
+                    continue
+                eps_values, pe_values = forecasts.setdefault(int(publish_date[:4]) + offset, ([], []))
+                eps_values.append(eps)
+                if pe is not None:
+                    pe_values.append(pe)
+
+        self.database.transaction()
+        for table in ("report_consensus", "eps_consensus"):
+            self.query.prepare(f"DELETE FROM {table} WHERE stock_code = ?;")
+            self.query.addBindValue(code)
+            self.query.exec()
+        if reports:
+            self.query.prepare("""
+                INSERT INTO report_consensus (
+                    stock_code, stock_name, reports, brokers, upgrades, downgrades, first_date, last_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?);""")
+            for value in (code, stock_name, reports, len(brokers), upgrades, downgrades, first_date, last_date):
+                self.query.addBindValue(value)
+            self.query.exec()
+        for year, (eps_values, pe_values) in forecasts.items():
+            self.query.prepare("""
+                INSERT INTO eps_consensus (
+                    stock_code, year, estimates, eps_sum, eps_sumsq, eps_min, eps_max, eps_median,
+                    pe_count, pe_sum)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""")
+            for value in (code, year, len(eps_values), float(sum(eps_values)),
+                          float(sum(eps * eps for eps in eps_values)), min(eps_values), max(eps_values),
+                          statistics.median(eps_values), len(pe_values), float(sum(pe_values))):
+                self.query.addBindValue(value)
+            self.query.exec()
+        self.database.commit()
+
+    @write_operation
+    def refresh_consensus(self):
+        """
+        recompute the consensus of the stocks marked dirty by the triggers,
+        return a Future of the number of stocks
+        """
+        codes = self.consensus_stocks_to_refresh()
+        for code in codes:
+            self.recompute_consensus(code)
+        return len(codes)
+
+    def query_consensus(self, year=None):
+        """
+        return the consensus of all stocks covered by study reports, with the
+        forecasts of year (this year by default). call refresh_consensus before
+        it to get up-to-date medians
+        """
+        year = year or datetime.date.today().year
+        self.query.prepare("""
+            SELECT r.stock_code, r.stock_name, r.reports, r.brokers, r.upgrades, r.downgrades,
+                r.last_date, e.estimates, e.eps_sum, e.eps_sumsq, e.eps_min, e.eps_max, e.eps_median,
+                e.pe_count, e.pe_sum
+            FROM report_consensus AS r
+            LEFT JOIN eps_consensus AS e ON e.stock_code = r.stock_code AND e.year = ?
+            ORDER BY r.stock_code;""")
+        self.query.addBindValue(year)
+        self.query.exec()
+
+        consensus = []
+        while self.query.next():
+            estimates = self.query.value(7) or 0
+            eps_mean = eps_std = pe_mean = None
+            if estimates:
+                eps_mean = self.query.value(8) / estimates
+                # 总体标准差，浮点误差可能使方差略小于 0
+                eps_std = math.sqrt(max(self.query.value(9) / estimates - eps_mean * eps_mean, 0.0))
+            if self.query.value(13):
+                pe_mean = self.query.value(14) / self.query.value(13)
+            consensus.append({
+                "StockCode": self.query.value(0),
+                "StockName": self.query.value(1),
+                "Reports": self.query.value(2),
+                "Brokers": self.query.value(3),
+                "Upgrades": self.query.value(4),
+                "Downgrades": self.query.value(5),
+                "LastDate": self.query.value(6),
+                "Year": year,
+                "Estimates": estimates,
+                "EpsMean": eps_mean,
+                "EpsMedian": self.query.value(12) if estimates else None,
+                "EpsStd": eps_std,
+                "EpsMin": self.query.value(10) if estimates else None,
+                "EpsMax": self.query.value(11) if estimates else None,
+                "PeMean": pe_mean})
+        return consensus
+
+    @write_operation
+    def upsert_quotes(self, quotes):
+        """
+        save quote dicts returned by quotes.get_market_data_many in one
+        transaction, replace the old quotes of the same codes
+        """
+        columns = [[] for _ in QUOTE_KEYS]
+        for quote in quotes:
+            for column, key in zip(columns, QUOTE_KEYS):
+                value = quote[key]
+                column.append(value if key in ("Code", "Name") else to_quote_number(value))
+        self.database.transaction()
+        self.query.prepare("""
+            INSERT OR REPLACE INTO quotes (
+                code, name, latest_price, change_rate, change_amount, pe_ttm, pb, market_value, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now', 'localtime'));""")
+        for column in columns:
+            self.query.addBindValue(column)
+        if not self.query.execBatch():
+            print("Unable to save quotes: ", self.query.lastError().text())
+            self.database.rollback()
+            return
+        self.database.commit()
+
+    def query_quotes(self, codes):
+        """return the saved quotes of codes in the format of quotes.get_market_data_many"""
+        self.query.prepare("""
+            SELECT code, name, latest_price, change_rate, change_amount, pe_ttm, pb, market_value
+            FROM quotes WHERE code IN (SELECT value FROM json_each(?));""")
+        self.query.addBindValue(json.dumps(list(codes)))
+        self.query.exec()
+
+        saved = []
+        while self.query.next():
+            saved.append({key: self.query.value(i) if i < 2 else to_quote_number(self.query.value(i))
+                          for i, key in enumerate(QUOTE_KEYS)})
+        return saved
+
     def query_stocks(self):
         """query stocks"""
         stocks_code = []
@@ -231,6 +1140,7 @@ class AnnouncementDatabase:
         
         return stocks_code
 
+    @write_operation
     def update_announcement_state(self, ann_id, state):
         """update a specified announcement"""
         sql = f"""UPDATE announcements SET state = '{state}' WHERE ann_id = {ann_id};"""
@@ -243,8 +1153,8 @@ if __name__ == "__main__":
 
     db = AnnouncementDatabase()
 
-    for report in reports:
-        db.insert_study_report(report)
+    inserted, ignored = db.insert_study_reports_bulk(reports).result()
+    print(f"{inserted} study reports inserted, {ignored} ignored")
     # db.insert_stock("601166", "兴业银行", "A股")
     # db.insert_announcement(2, "601166", "迈瑞医疗", "迈瑞医疗年报", "2022-03-31", "http://baidu.com", "UNREAD")
     # db.insert_announcement(3, "601167", "伊利股份", "迈瑞医疗年报", "2022-03-31", "http://baidu.com", "UNREAD")
@@ -0,0 +1,222 @@
+"""
+docstore.py
+本地公告和研究报告 pdf 文件的缓存
+
+文件按内容的 sha256 保存在 DOCSTORE_PATH 下，内容相同的文件只保存一份；
+数据库中的 documents 表记录每个公告 (ann_id) 或研究报告 (info_code)
+对应的文件、url、大小和获取时间。缓存总大小超过 DOCSTORE_MAX_BYTES 时，
+删除最久没有打开过的文件。
+"""
+import os
+import time
+import atexit
+import datetime
+import shutil
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+import httpclient
+
+
+DOCSTORE_PATH = "files/documents"
+# 缓存文件的总大小上限
+DOCSTORE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# 后台下载的线程数
+PREFETCH_WORKERS = 2
+# 文件的访问时间先记在内存中，最多每隔这么多秒写一次数据库
+TOUCH_FLUSH_INTERVAL = 30
+CHUNK_SIZE = 64 * 1024
+
+
+def announcement_doc_key(ann_id):
+    """the document key of an announcement"""
+    return f"announcement:{ann_id}"
+
+
+def study_report_doc_key(info_code):
+    """the document key of a study report"""
+    return f"study_report:{info_code}"
+
+
+def file_hash(path):
+    """sha256 of a file"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DocumentStore:
+    """
+    content addressed document cache, the manifest is kept in the
+    documents table of an AnnouncementDatabase
+    """
+    def __init__(self, db, directory=DOCSTORE_PATH, max_bytes=DOCSTORE_MAX_BYTES):
+        self.db = db
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # 正在后台下载的 doc_key
+        self.pending = set()
+        # 正在删除的文件 hash -> size
+        self.evicting = {}
+        # 还没有写入数据库的访问时间 doc_key -> accessed_at
+        self.accessed = {}
+        self.last_flush = time.monotonic()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+        atexit.register(self.close)
+
+    def close(self):
+        """wait for the background jobs and write the access times kept in memory"""
+        self.executor.shutdown(wait=True)
+        self.flush_access_times()
+
+    def object_path(self, hash):
+        """path of the stored file with the content hash"""
+        return os.path.join(self.directory, hash[:2], hash + ".pdf")
+
+    def get(self, doc_key):
+        """return the local path of a document, None if it has not been fetched"""
+        record = self.db.query_document(doc_key)
+        if record is None:
+            return None
+        path = self.object_path(record["Hash"])
+        with self.lock:
+            if record["Hash"] in self.evicting:
+                return None
+        if not os.path.exists(path):
+            return None
+        self.touch(doc_key)
+        return path
+
+    def touch(self, doc_key):
+        """record the access time of a document, written to the database in batches"""
+        with self.lock:
+            # 与 insert_document 写入的 accessed_at 格式相同
+            self.accessed[doc_key] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            due = time.monotonic() - self.last_flush >= TOUCH_FLUSH_INTERVAL
+        if due:
+            self.flush_access_times()
+
+    def flush_access_times(self):
+        """write the access times kept in memory, return a Future or None"""
+        with self.lock:
+            accessed, self.accessed = self.accessed, {}
+            self.last_flush = time.monotonic()
+        if not accessed:
+            return None
+        return self.db.touch_documents(accessed)
+
+    def add_object(self, tmp_path, hash):
+        """move a fetched file into the store, drop it if the same content is stored"""
+        path = self.object_path(hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        return path
+
+    def add(self, doc_key, url, tmp_path, hash):
+        path = self.add_object(tmp_path, hash)
+        self.db.insert_document(doc_key, url, hash, os.path.getsize(path)).result()
+        # 在后台线程中清理，调用者不需要等待
+        future = self.executor.submit(self.run_in_background, self.evict, hash)
+        future.add_done_callback(self.evict_done)
+        return path
+
+    def fetch(self, doc_key, url):
+        """download url into the store, return the local path"""
+        sha256 = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file, httpclient.client.get(url, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    file.write(chunk)
+                    sha256.update(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self.add(doc_key, url, tmp_path, sha256.hexdigest())
+
+    def put_file(self, doc_key, url, path):
+        """add a file downloaded somewhere else to the store, return the stored path"""
+        hash = file_hash(path)
+        if os.path.exists(self.object_path(hash)):
+            self.db.insert_document(doc_key, url, hash, os.path.getsize(path)).result()
+            return self.object_path(hash)
+
+        fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=self.directory)
+        os.close(fd)
+        shutil.copyfile(path, tmp_path)
+        return self.add(doc_key, url, tmp_path, hash)
+
+    def prefetch(self, doc_key, url):
+        """fetch a document in the background, return a Future of its path"""
+        with self.lock:
+            if doc_key in self.pending:
+                return None
+            self.pending.add(doc_key)
+        future = self.executor.submit(self.run_in_background, self.fetch, doc_key, url)
+        future.add_done_callback(lambda f: self.prefetch_done(doc_key, f))
+        return future
+
+    def run_in_background(self, func, *args):
+        """run func in an executor thread, close the database connection it opens"""
+        try:
+            return func(*args)
+        finally:
+            self.db.close_thread_connection()
+
+    def prefetch_done(self, doc_key, future):
+        with self.lock:
+            self.pending.discard(doc_key)
+        e = future.exception()
+        if e is not None:
+            print(f"Some exception occured when fetching {doc_key}: ", e)
+
+    def evict_done(self, future):
+        e = future.exception()
+        if e is not None:
+            print("Some exception occured when evicting documents: ", e)
+
+    def evict(self, keep=None):
+        """
+        delete the least recently used files until the store fits in max_bytes.
+        只在锁内选出要删除的文件，删除文件和数据库记录时不持有锁
+        """
+        write = self.flush_access_times()
+        if write is not None:
+            write.result()
+        usage = self.db.query_document_usage()
+
+        victims = []
+        with self.lock:
+            # 其它线程正在删除的文件不再计入
+            total = sum(size for hash, size in usage if hash not in self.evicting)
+            for hash, size in usage:
+                if total <= self.max_bytes:
+                    break
+                if hash == keep or hash in self.evicting:
+                    continue
+                victims.append(hash)
+                self.evicting[hash] = size
+                total -= size
+        if not victims:
+            return
+
+        try:
+            for hash in victims:
+                try:
+                    os.remove(self.object_path(hash))
+                except FileNotFoundError:
+                    pass
+            self.db.delete_documents(victims).result()
+        finally:
+            with self.lock:
+                for hash in victims:
+                    del self.evicting[hash]
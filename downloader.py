@@ -0,0 +1,204 @@
+"""
+downloader.py
+并发下载公告 pdf 文件
+
+多个线程同时下载，数据按块直接写入磁盘；未完成的文件保存为 .part，
+下次用 HTTP Range 请求续传；下载完成后再改名，目录中不会出现不完整的文件。
+已经存在且大小或 ETag 与服务器一致的文件不会重新下载。
+"""
+import os
+import json
+import threading
+import concurrent.futures
+import requests
+import httpclient
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+# 每个下载目录中记录已下载文件 ETag 和大小的索引文件
+INDEX_FILE_NAME = ".downloads.json"
+
+
+class DownloadEngine:
+    """
+    download (url, path) tasks in parallel.
+
+    on_progress(done_bytes, total_bytes) is called from the worker threads
+    with the bytes downloaded by all workers, on_file_done(url, path, ok)
+    is called when a file is finished, skipped or failed.
+    """
+    def __init__(self, max_workers=MAX_WORKERS, on_progress=None, on_file_done=None):
+        self.max_workers = max_workers
+        self.on_progress = on_progress
+        self.on_file_done = on_file_done
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.done_bytes = 0
+        self.total_bytes = 0
+        # directory -> {file name: {"etag": ..., "size": ...}}
+        self.indexes = {}
+        # 提交到线程池的任务，stop 时取消还没有开始的
+        self.futures = []
+
+    def stop(self):
+        """stop downloading and cancel the queued files, the partial files are kept for resuming"""
+        self.stopped.set()
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+
+    def submit(self, executor, func, *args):
+        """submit a task that stop() can cancel while it is still queued"""
+        future = executor.submit(func, *args)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def load_index(self, directory):
+        if directory not in self.indexes:
+            try:
+                with open(os.path.join(directory, INDEX_FILE_NAME), encoding="utf-8") as file:
+                    self.indexes[directory] = json.load(file)
+            except (OSError, ValueError):
+                self.indexes[directory] = {}
+        return self.indexes[directory]
+
+    def save_index(self, path, etag, size):
+        """record the ETag and size of a finished file"""
+        directory, name = os.path.split(path)
+        with self.lock:
+            index = self.load_index(directory)
+            index[name] = {"etag": etag, "size": size}
+            tmp_path = os.path.join(directory, INDEX_FILE_NAME + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(index, file, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(directory, INDEX_FILE_NAME))
+
+    def add_progress(self, done=0, total=0):
+        with self.lock:
+            self.done_bytes += done
+            self.total_bytes += total
+            done_bytes, total_bytes = self.done_bytes, self.total_bytes
+        if self.on_progress is not None:
+            self.on_progress(done_bytes, total_bytes)
+
+    def probe(self, url, path):
+        """
+        HEAD the url, return (etag, size) of the remote file and whether
+        the local file is already up to date, None if stopped
+        """
+        if self.stopped.is_set():
+            return None
+        response = httpclient.client.head(url, allow_redirects=True)
+        etag = response.headers.get("ETag")
+        size = int(response.headers.get("Content-Length", 0)) or None
+        if not os.path.exists(path):
+            return etag, size, False
+
+        with self.lock:
+            record = self.load_index(os.path.dirname(path)).get(os.path.basename(path), {})
+        if etag is not None and record.get("etag") == etag:
+            return etag, size, True
+        if size is not None and os.path.getsize(path) == size:
+            return etag, size, True
+        return etag, size, False
+
+    def fetch(self, url, path, etag, counted=0):
+        """
+        download url to path, resume from path.part if it exists.
+        counted is the number of bytes of path.part already added to the progress.
+        return False if stopped
+        """
+        part_path = path + ".part"
+        for attempt in range(MAX_RETRIES + 1):
+            if self.stopped.is_set():
+                return False
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {}
+            # 只有能确认服务器上的文件没有变化时才续传
+            if offset > 0 and etag is not None:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = etag
+            else:
+                offset = 0
+
+            try:
+                with httpclient.client.get(url, headers=headers, stream=True) as response:
+                    if response.status_code == 416:
+                        # 已经下载完整了
+                        break
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        # 服务器返回了整个文件，从头开始写
+                        self.add_progress(done=-counted)
+                        counted = 0
+                        offset = 0
+                    with open(part_path, "ab" if offset else "wb") as file:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            if self.stopped.is_set():
+                                return False
+                            file.write(chunk)
+                            counted += len(chunk)
+                            self.add_progress(done=len(chunk))
+                    etag = response.headers.get("ETag", etag)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt >= MAX_RETRIES:
+                    raise
+                print(f"Download interrupted ({e}), resume: ", url)
+
+        os.replace(part_path, path)
+        self.save_index(path, etag, os.path.getsize(path))
+        return True
+
+    def file_done(self, url, path, ok):
+        if self.on_file_done is not None:
+            self.on_file_done(url, path, ok)
+
+    def download_all(self, tasks):
+        """
+        download a list of (url, path), return the list of failed tasks.
+        先并发探测所有文件的大小，得到总字节数，再并发下载。
+        """
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            probes = {self.submit(executor, self.probe, url, path): (url, path) for url, path in tasks}
+            pending = []
+            for future in concurrent.futures.as_completed(probes):
+                url, path = probes[future]
+                try:
+                    # 停止后被取消或者没有探测的文件返回 None
+                    result = None if future.cancelled() else future.result()
+                except (requests.RequestException, OSError) as e:
+                    print(f"Some exception occured when probing {url}: ", e)
+                    result = None
+                if result is None:
+                    failed.append((url, path))
+                    self.file_done(url, path, False)
+                    continue
+                etag, size, up_to_date = result
+                if up_to_date:
+                    self.file_done(url, path, True)
+                    continue
+
+                part_path = path + ".part"
+                resumed = os.path.getsize(part_path) if etag and os.path.exists(part_path) else 0
+                self.add_progress(done=resumed, total=size or 0)
+                pending.append((url, path, etag, resumed))
+
+            fetches = {self.submit(executor, self.fetch, url, path, etag, resumed): (url, path)
+                       for url, path, etag, resumed in pending}
+            for future in concurrent.futures.as_completed(fetches):
+                url, path = fetches[future]
+                try:
+                    ok = not future.cancelled() and future.result()
+                except (requests.RequestException, OSError) as e:
+                    print(f"Some exception occured when downloading {url}: ", e)
+                    ok = False
+                if not ok:
+                    failed.append((url, path))
+                self.file_done(url, path, ok)
+        return failed
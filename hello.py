@@ -1,28 +1,25 @@
-import urllib.request
 import re
+import requests
 from lxml.html import etree
-from urllib.error import URLError, HTTPError, ContentTooShortError
+import httpclient
 
 
 def download(url, user_agent='wswp', num_retries=2, charset='utf-8'):
     print("Downloading: ", url)
-    
-    handler = urllib.request.ProxyHandler({
+
+    proxies = {
         "http": "127.0.0.1:10809",
         "https": "127.0.0.1:10809"
-    })
-    opener = urllib.request.build_opener(handler)
-    request = urllib.request.Request(url)
-    request.add_header('User-agent', user_agent)
+    }
+    headers = {'User-agent': user_agent}
 
     try:
-        html = opener.open(request).read().decode(charset)
-    except (URLError, HTTPError, ContentTooShortError) as e:
-        print("Download error: ", e.reason)
+        r = httpclient.get(url, headers=headers, proxies=proxies, max_retries=num_retries)
+        r.raise_for_status()
+        html = r.content.decode(charset)
+    except requests.RequestException as e:
+        print("Download error: ", e)
         html = None
-        if num_retries > 0:
-            if hasattr(e, 'code') and 500 <= e.code < 600:
-                return download(url, num_retries-1)
     return html
 
 
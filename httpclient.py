@@ -0,0 +1,155 @@
+"""
+httpclient.py
+抓取数据时共用的网络工具
+
+所有抓取代码都通过这里的 client 发请求：
+每个域名一个 keep-alive 的 session 和连接池，每个域名一个令牌桶限速，
+遇到 429 和 5xx 时按带随机抖动的指数退避重试。
+"""
+import time
+import random
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# 每个域名默认每秒最多请求的次数，以及允许的突发请求数
+DEFAULT_RATE = 5
+DEFAULT_BURST = 5
+# 单独设置的域名限速 (rate, burst)
+DOMAIN_LIMITS = {
+    "www.cninfo.com.cn": (2, 2),
+}
+# 每个域名的连接池大小
+POOL_SIZE = 10
+TIMEOUT = 10
+# 重试的次数和退避时间
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:100.0) Gecko/20100101 Firefox/100.0"
+
+
+class RateLimiter:
+    """
+    token bucket rate limiter, one bucket per domain.
+    thread safe, acquire() blocks until a token is available.
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, limits=None):
+        self.rate = rate
+        self.burst = burst
+        # domain -> (rate, burst)
+        self.limits = dict(limits or {})
+        # domain -> [tokens, last refill time]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def set_limit(self, domain, rate, burst=1):
+        """set the rate of a domain, rate <= 0 means no limit"""
+        with self.lock:
+            self.limits[domain] = (rate, burst)
+            self.buckets.pop(domain, None)
+
+    def acquire(self, domain):
+        """take a token of the domain, sleep until one is available"""
+        while True:
+            with self.lock:
+                rate, burst = self.limits.get(domain, (self.rate, self.burst))
+                if rate <= 0:
+                    return
+                now = time.monotonic()
+                tokens, last = self.buckets.get(domain, (burst, now))
+                tokens = min(burst, tokens + (now - last) * rate)
+                if tokens >= 1:
+                    self.buckets[domain] = (tokens - 1, now)
+                    return
+                self.buckets[domain] = (tokens, now)
+                sleep_secs = (1 - tokens) / rate
+            time.sleep(sleep_secs)
+
+    def wait(self, url):
+        """take a token of the domain of url"""
+        self.acquire(urlparse(url).netloc)
+
+
+def backoff_delay(attempt, response=None):
+    """
+    seconds to wait before retry attempt (starting from 0): exponential
+    backoff with full jitter, or the Retry-After header of a 429 response
+    """
+    if response is not None and response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(BACKOFF_MAX, int(retry_after))
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class HttpClient:
+    """
+    http client shared by all scrapers: a pooled keep-alive session
+    per host, a rate limit per domain and retries with backoff
+    """
+    def __init__(self, limiter=None, user_agent=USER_AGENT):
+        self.limiter = limiter or RateLimiter(limits=DOMAIN_LIMITS)
+        self.user_agent = user_agent
+        # host -> requests.Session
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        """return the session of the host of url"""
+        parsed = urlparse(url)
+        host = f"{parsed.scheme}://{parsed.netloc}"
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+                session.headers["user-agent"] = self.user_agent
+                self.sessions[host] = session
+        return session
+
+    def request(self, method, url, max_retries=MAX_RETRIES, timeout=TIMEOUT, **kwargs):
+        """
+        send a request, retry on connection errors, timeouts, 429 and 5xx.
+        return the last response, the caller checks its status code.
+        raise the last requests exception if no response is received.
+        """
+        session = self.session(url)
+        attempt = 0
+        while True:
+            self.limiter.wait(url)
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= max_retries:
+                    raise
+                print(f"Request failed ({e}), retry: ", url)
+                time.sleep(backoff_delay(attempt))
+            else:
+                if response.status_code not in RETRY_STATUS or attempt >= max_retries:
+                    return response
+                print(f"Server returned {response.status_code}, retry: ", url)
+                delay = backoff_delay(attempt, response)
+                response.close()
+                time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+
+# 所有抓取代码共用的限速器和 client
+limiter = RateLimiter(limits=DOMAIN_LIMITS)
+client = HttpClient(limiter)
+
+
+def get(url, **kwargs):
+    """GET url with the shared client"""
+    return client.get(url, **kwargs)
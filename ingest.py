@@ -0,0 +1,151 @@
+"""
+ingest.py
+不依赖界面的数据抓取程序
+
+按固定的间隔抓取自选股的公告、研报、行情和财务报表，写入与界面相同的
+files/announcements.db 和 cache/store，界面只需要读取本地已经准备好的数据。
+可以用 cron 定时运行一次（--once），也可以作为 systemd 服务一直运行。
+
+用法: python -m ingest [任务 ...] [--once] [--workers N] [--interval 任务=秒]
+"""
+import sys
+import time
+import signal
+import argparse
+import datetime
+import threading
+import concurrent.futures
+from PyQt6.QtCore import QCoreApplication
+import createdb
+import collectors
+import quotes
+import statementstore
+import statementcache
+
+
+# 同时抓取的股票数量
+INGEST_MAX_WORKERS = 8
+# 每个任务默认的运行间隔（秒）
+JOB_INTERVALS = {
+    "quotes": 60,
+    "announcements": 15 * 60,
+    "study_reports": 6 * 60 * 60,
+    "statements": 24 * 60 * 60,
+}
+
+
+def ingest_announcements(db, codes, max_workers):
+    inserted = collectors.collect_announcements(db, codes, max_workers)
+    return f"{inserted} announcements inserted"
+
+
+def ingest_study_reports(db, codes, max_workers):
+    rowids = collectors.collect_study_reports(db, codes, max_workers)
+    if rowids:
+        db.refresh_consensus().result()
+    return f"{len(rowids)} study reports inserted"
+
+
+def ingest_quotes(db, codes, max_workers):
+    stocks_data = quotes.get_market_data_many(codes)
+    db.upsert_quotes(stocks_data).result()
+    return f"{len(stocks_data)} quotes saved"
+
+
+def ingest_statements(db, codes, max_workers):
+    """download the statements that can have a newer report, see statementcache.is_fresh"""
+    cache = statementcache.StatementCache(statementstore.StatementStore())
+    # 财务报表接口只支持 A 股
+    codes = [code for code in codes if quotes.get_secid(code) is not None]
+
+    def update(code):
+        for category in statementstore.CATEGORIES:
+            cache.get(code, category)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(update, code): code for code in codes}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Some exception occured when updating the statements of {futures[future]}: ", e)
+    return statementcache.format_stats(cache.stats())
+
+
+JOBS = {
+    "quotes": ingest_quotes,
+    "announcements": ingest_announcements,
+    "study_reports": ingest_study_reports,
+    "statements": ingest_statements,
+}
+
+
+def run_job(db, name, max_workers):
+    """run a job for the current watchlist, print its result or exception"""
+    start = time.perf_counter()
+    try:
+        result = JOBS[name](db, db.query_stocks(), max_workers)
+    except Exception as e:
+        print(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {name} failed: ", e)
+        return
+    print(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {name}: {result} "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+def run_schedule(db, intervals, max_workers, stop_event):
+    """run every job at its interval until stop_event is set, due jobs run one by one"""
+    next_runs = {name: 0.0 for name in intervals}
+    while not stop_event.is_set():
+        now = time.monotonic()
+        for name, next_run in next_runs.items():
+            if next_run <= now and not stop_event.is_set():
+                run_job(db, name, max_workers)
+                next_runs[name] = now + intervals[name]
+        stop_event.wait(max(0.0, min(next_runs.values()) - time.monotonic()))
+
+
+def parse_interval(text):
+    name, _, seconds = text.partition("=")
+    if name not in JOBS or not seconds:
+        raise argparse.ArgumentTypeError(f"expected one of {', '.join(JOBS)}=SECONDS, got {text}")
+    return name, float(seconds)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="抓取自选股的数据并写入本地数据库")
+    parser.add_argument("jobs", nargs="*", metavar="JOB",
+                        help=f"要运行的任务（{', '.join(JOBS)}），默认全部")
+    parser.add_argument("--once", action="store_true", help="每个任务只运行一次，用于 cron")
+    parser.add_argument("--workers", type=int, default=INGEST_MAX_WORKERS, help="同时抓取的股票数量")
+    parser.add_argument("--interval", type=parse_interval, action="append", default=[],
+                        metavar="JOB=SECONDS", help="修改任务的运行间隔，可以重复")
+    parser.add_argument("--database", default=createdb.DATABASE_PATH, help="数据库文件")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.jobs if name not in JOBS]
+    if unknown:
+        parser.error(f"unknown jobs: {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    jobs = args.jobs or list(JOBS)
+
+    app = QCoreApplication(sys.argv)
+    db = createdb.AnnouncementDatabase(args.database)
+    if args.once:
+        for name in jobs:
+            run_job(db, name, args.workers)
+    else:
+        intervals = {name: JOB_INTERVALS[name] for name in jobs}
+        intervals.update((name, seconds) for name, seconds in args.interval if name in intervals)
+        stop_event = threading.Event()
+        # systemd 停止服务时发送 SIGTERM，完成当前任务后退出
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+        run_schedule(db, intervals, args.workers, stop_event)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
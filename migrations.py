@@ -0,0 +1,476 @@
+"""
+migrations.py
+数据库结构的版本迁移
+
+数据库当前的版本号保存在 PRAGMA user_version 中，
+打开数据库时依次执行版本号之后的迁移，每个迁移在一个事务中完成，
+已有的数据库会原地升级，不会丢失数据。
+新的迁移只能追加到 MIGRATIONS 的末尾，不能修改已经发布的迁移。
+"""
+import sys
+from PyQt6.QtSql import QSqlQuery
+
+
+class MigrationError(Exception):
+    """raised when a statement of a migration fails"""
+
+
+def execute(query, sql):
+    """execute sql, raise MigrationError if it fails"""
+    if not query.exec(sql):
+        raise MigrationError(f"{query.lastError().text()} ({sql.strip()})")
+
+
+def column_exists(query, table, column):
+    """check whether the table has the column"""
+    execute(query, f"PRAGMA table_info({table});")
+    while query.next():
+        if query.value(1) == column:
+            return True
+    return False
+
+
+def get_user_version(database):
+    """return the schema version of the database"""
+    query = QSqlQuery(database)
+    query.exec("PRAGMA user_version;")
+    query.next()
+    return query.value(0)
+
+
+def add_study_report_url_and_indexes(query):
+    """
+    version 1: add the url column which insert_study_report writes to,
+    and the indexes used by query_announcements and query_study_reports
+    """
+    if not column_exists(query, "study_reports", "url"):
+        execute(query, "ALTER TABLE study_reports ADD COLUMN url NTEXT;")
+
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_announcements_state_date
+        ON announcements (state, ann_date);""")
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_announcements_code_date
+        ON announcements (code, ann_date);""")
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_study_reports_stock_date
+        ON study_reports (stock_code, publish_date);""")
+    # query_study_reports 按 publish_date 对所有股票排序
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_study_reports_date
+        ON study_reports (publish_date);""")
+
+
+def add_announcement_page_index(query):
+    """
+    version 2: index for the keyset pagination of query_announcements_page,
+    so a page is read in index order without sorting the whole table
+    """
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_announcements_date_id
+        ON announcements (ann_date, ann_id);""")
+
+
+def add_announcement_sync_state(query):
+    """
+    version 3: the newest announcement already ingested for every stock,
+    seeded from the announcements in the database
+    """
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS announcement_sync_state (
+            code VARCHAR(6) PRIMARY KEY NOT NULL,
+            last_ann_date DATE,
+            last_ann_id INTEGER,
+            synced_at DATETIME);""")
+    execute(query, """
+        INSERT OR IGNORE INTO announcement_sync_state (code, last_ann_date, last_ann_id)
+        SELECT code, ann_date, MAX(ann_id) FROM announcements AS a
+        WHERE ann_date = (SELECT MAX(ann_date) FROM announcements AS b WHERE b.code = a.code)
+        GROUP BY code;""")
+
+
+def add_documents(query):
+    """
+    version 4: manifest of the local document store, one row per
+    announcement or study report, rows with the same content share a hash
+    """
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS documents (
+            doc_key NTEXT PRIMARY KEY NOT NULL,
+            url NTEXT,
+            hash VARCHAR(64) NOT NULL,
+            size INTEGER NOT NULL,
+            fetched_at DATETIME,
+            accessed_at DATETIME);""")
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_documents_hash
+        ON documents (hash);""")
+
+
+def add_full_text_index(query):
+    """
+    version 5: FTS5 indexes of announcement titles and study reports.
+    trigram 分词不依赖空格，适用于中文；索引不保存内容，
+    由触发器与原表保持同步，已有的数据在这里一次性建立索引。
+    """
+    execute(query, """
+        CREATE VIRTUAL TABLE IF NOT EXISTS announcements_fts USING fts5(
+            title,
+            content='announcements', content_rowid='ann_id', tokenize='trigram');""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS announcements_fts_insert AFTER INSERT ON announcements BEGIN
+            INSERT INTO announcements_fts (rowid, title) VALUES (new.ann_id, new.title);
+        END;""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS announcements_fts_delete AFTER DELETE ON announcements BEGIN
+            INSERT INTO announcements_fts (announcements_fts, rowid, title)
+            VALUES ('delete', old.ann_id, old.title);
+        END;""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS announcements_fts_update AFTER UPDATE OF title ON announcements BEGIN
+            INSERT INTO announcements_fts (announcements_fts, rowid, title)
+            VALUES ('delete', old.ann_id, old.title);
+            INSERT INTO announcements_fts (rowid, title) VALUES (new.ann_id, new.title);
+        END;""")
+    execute(query, "INSERT INTO announcements_fts (announcements_fts) VALUES ('rebuild');")
+
+    execute(query, """
+        CREATE VIRTUAL TABLE IF NOT EXISTS study_reports_fts USING fts5(
+            title, org_name, authors, industry_name,
+            content='study_reports', content_rowid='rowid', tokenize='trigram');""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS study_reports_fts_insert AFTER INSERT ON study_reports BEGIN
+            INSERT INTO study_reports_fts (rowid, title, org_name, authors, industry_name)
+            VALUES (new.rowid, new.title, new.org_name, new.authors, new.industry_name);
+        END;""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS study_reports_fts_delete AFTER DELETE ON study_reports BEGIN
+            INSERT INTO study_reports_fts (study_reports_fts, rowid, title, org_name, authors, industry_name)
+            VALUES ('delete', old.rowid, old.title, old.org_name, old.authors, old.industry_name);
+        END;""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS study_reports_fts_update
+        AFTER UPDATE OF title, org_name, authors, industry_name ON study_reports BEGIN
+            INSERT INTO study_reports_fts (study_reports_fts, rowid, title, org_name, authors, industry_name)
+            VALUES ('delete', old.rowid, old.title, old.org_name, old.authors, old.industry_name);
+            INSERT INTO study_reports_fts (rowid, title, org_name, authors, industry_name)
+            VALUES (new.rowid, new.title, new.org_name, new.authors, new.industry_name);
+        END;""")
+    execute(query, "INSERT INTO study_reports_fts (study_reports_fts) VALUES ('rebuild');")
+
+
+def add_document_pages(query):
+    """
+    version 6: page text of the stored pdf files and its FTS5 index.
+    document_text 记录每个文件（按内容 hash）的提取状态，与页面文本在同一个
+    事务中写入，中断后重新运行时跳过已经完成的文件
+    """
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS document_text (
+            hash VARCHAR(64) PRIMARY KEY NOT NULL,
+            size INTEGER,
+            pages INTEGER,
+            error NTEXT,
+            extracted_at DATETIME);""")
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS document_pages (
+            id INTEGER PRIMARY KEY,
+            hash VARCHAR(64) NOT NULL,
+            page INTEGER NOT NULL,
+            text NTEXT);""")
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_document_pages_hash
+        ON document_pages (hash, page);""")
+    execute(query, """
+        CREATE VIRTUAL TABLE IF NOT EXISTS document_pages_fts USING fts5(
+            text,
+            content='document_pages', content_rowid='id', tokenize='trigram');""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS document_pages_fts_insert AFTER INSERT ON document_pages BEGIN
+            INSERT INTO document_pages_fts (rowid, text) VALUES (new.id, new.text);
+        END;""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS document_pages_fts_delete AFTER DELETE ON document_pages BEGIN
+            INSERT INTO document_pages_fts (document_pages_fts, rowid, text)
+            VALUES ('delete', old.id, old.text);
+        END;""")
+
+
+# 研报预测的年份相对发布年份的偏移 -> (每股收益列, 市盈率列)
+FORECAST_COLUMNS = {
+    0: ("predict_ty_eps", "predict_ty_pe"),
+    1: ("predict_ny_eps", "predict_ny_pe"),
+    2: ("predict_n2y_eps", "predict_n2y_pe"),
+}
+
+
+def is_number(column):
+    """sql testing that a column holds a number, the api returns '' for missing values"""
+    return f"typeof({column}) IN ('integer', 'real')"
+
+
+def create_study_report_consensus_triggers(query):
+    """triggers of study_reports that keep report_consensus and eps_consensus up to date"""
+    # 评级数值越大越看好：3 买入, 2 增持, 1 持有
+    upgrade = f"""({is_number("new.em_rating_value")} AND {is_number("new.last_rating_value")}
+                   AND new.em_rating_value > new.last_rating_value)"""
+    downgrade = f"""({is_number("new.em_rating_value")} AND {is_number("new.last_rating_value")}
+                     AND new.em_rating_value < new.last_rating_value)"""
+    eps_upserts = ""
+    for offset, (eps, pe) in FORECAST_COLUMNS.items():
+        eps_upserts += f"""
+            INSERT INTO eps_consensus (
+                stock_code, year, estimates, eps_sum, eps_sumsq, eps_min, eps_max, eps_median,
+                pe_count, pe_sum)
+            SELECT new.stock_code, CAST(substr(new.publish_date, 1, 4) AS INTEGER) + {offset}, 1,
+                new.{eps}, new.{eps} * new.{eps}, new.{eps}, new.{eps}, new.{eps},
+                {is_number("new." + pe)}, IIF({is_number("new." + pe)}, new.{pe}, 0)
+            WHERE {is_number("new." + eps)}
+            ON CONFLICT (stock_code, year) DO UPDATE SET
+                estimates = estimates + 1,
+                eps_sum = eps_sum + excluded.eps_sum,
+                eps_sumsq = eps_sumsq + excluded.eps_sumsq,
+                eps_min = MIN(eps_min, excluded.eps_min),
+                eps_max = MAX(eps_max, excluded.eps_max),
+                pe_count = pe_count + excluded.pe_count,
+                pe_sum = pe_sum + excluded.pe_sum,
+                dirty = 1;"""
+    execute(query, f"""
+        CREATE TRIGGER IF NOT EXISTS study_reports_consensus_insert AFTER INSERT ON study_reports BEGIN
+            INSERT INTO report_consensus (
+                stock_code, stock_name, reports, brokers, upgrades, downgrades, first_date, last_date)
+            VALUES (new.stock_code, new.stock_name, 1, 1, {upgrade}, {downgrade},
+                new.publish_date, new.publish_date)
+            ON CONFLICT (stock_code) DO UPDATE SET
+                stock_name = IIF(excluded.last_date >= last_date, excluded.stock_name, stock_name),
+                reports = reports + 1,
+                brokers = brokers + NOT EXISTS (
+                    SELECT 1 FROM study_reports
+                    WHERE stock_code = new.stock_code AND org_name = new.org_name
+                    AND rowid <> new.rowid),
+                upgrades = upgrades + excluded.upgrades,
+                downgrades = downgrades + excluded.downgrades,
+                first_date = MIN(first_date, excluded.first_date),
+                last_date = MAX(last_date, excluded.last_date);{eps_upserts}
+        END;""")
+    # 删除和修改研报时只标记这只股票，由 refresh_consensus 从研报表重新计算
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS study_reports_consensus_delete AFTER DELETE ON study_reports BEGIN
+            UPDATE report_consensus SET dirty = 1 WHERE stock_code = old.stock_code;
+        END;""")
+    execute(query, """
+        CREATE TRIGGER IF NOT EXISTS study_reports_consensus_update AFTER UPDATE ON study_reports BEGIN
+            UPDATE report_consensus SET dirty = 1 WHERE stock_code IN (old.stock_code, new.stock_code);
+        END;""")
+
+
+def add_study_report_consensus(query):
+    """
+    version 7: consensus of the study reports of every stock.
+    report_consensus 每只股票一行：研报数、券商数、上调和下调评级的次数；
+    eps_consensus 每只股票每个预测年度一行：预测数、每股收益的和与平方和（用于均值和标准差）、
+    最大最小值和中位数、市盈率的和。
+    插入研报时由触发器增量更新计数和求和，中位数不能增量计算，
+    相关的行标记 dirty，由 AnnouncementDatabase.refresh_consensus 按股票重新计算。
+    """
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS report_consensus (
+            stock_code VARCHAR(6) PRIMARY KEY NOT NULL,
+            stock_name NVARCHAR(10),
+            reports INTEGER NOT NULL,
+            brokers INTEGER NOT NULL,
+            upgrades INTEGER NOT NULL,
+            downgrades INTEGER NOT NULL,
+            first_date DATE,
+            last_date DATE,
+            dirty INTEGER NOT NULL DEFAULT 0);""")
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS eps_consensus (
+            stock_code VARCHAR(6) NOT NULL,
+            year INTEGER NOT NULL,
+            estimates INTEGER NOT NULL,
+            eps_sum REAL NOT NULL,
+            eps_sumsq REAL NOT NULL,
+            eps_min REAL,
+            eps_max REAL,
+            eps_median REAL,
+            pe_count INTEGER NOT NULL,
+            pe_sum REAL NOT NULL,
+            dirty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (stock_code, year)) WITHOUT ROWID;""")
+    # 只索引需要重新计算的少数行
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_report_consensus_dirty
+        ON report_consensus (dirty) WHERE dirty = 1;""")
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_eps_consensus_dirty
+        ON eps_consensus (dirty) WHERE dirty = 1;""")
+    # 同一家券商以前发布过这只股票的研报
+    execute(query, """
+        CREATE INDEX IF NOT EXISTS idx_study_reports_stock_org
+        ON study_reports (stock_code, org_name);""")
+
+    create_study_report_consensus_triggers(query)
+    # 已有的研报全部标记为需要计算
+    execute(query, """
+        INSERT OR IGNORE INTO report_consensus (
+            stock_code, reports, brokers, upgrades, downgrades, dirty)
+        SELECT DISTINCT stock_code, 0, 0, 0, 0, 1 FROM study_reports;""")
+
+
+def add_quotes(query):
+    """
+    version 8: the latest quote of every selected stock, written by ingest.py,
+    so the GUI can show quotes before its first request
+    """
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS quotes (
+            code VARCHAR(6) PRIMARY KEY NOT NULL,
+            name NVARCHAR(10),
+            latest_price REAL,
+            change_rate REAL,
+            change_amount REAL,
+            pe_ttm REAL,
+            pb REAL,
+            market_value REAL,
+            updated_at DATETIME);""")
+
+
+
+def add_study_report_id(query):
+    """
+    version 9: add the INTEGER PRIMARY KEY column id to study_reports and use it
+    as the content_rowid of study_reports_fts. info_code 是 TEXT 主键，
+    隐含的 rowid 在 VACUUM 时可能重新编号，外部内容索引会指向错误的研报。
+    重建表时 id 取原来的 rowid，已有的索引数据仍然对应
+    """
+    execute(query, "DROP TABLE IF EXISTS study_reports_fts;")
+    if not column_exists(query, "study_reports", "id"):
+        columns = """info_code, title, stock_code, stock_name, org_name, publish_date,
+            predict_n2y_eps, predict_n2y_pe, predict_ny_eps, predict_ny_pe,
+            predict_ty_eps, predict_ty_pe, predict_ly_eps, predict_ly_pe,
+            industry_name, em_rating_value, em_rating_name, last_rating_value,
+            last_rating_name, authors, url"""
+        execute(query, """
+            CREATE TABLE study_reports_new (
+                id INTEGER PRIMARY KEY,
+                info_code VARCHAR(20) UNIQUE NOT NULL,
+                title NTEXT NOT NULL,
+                stock_code VARCHAR(6) NOT NULL,
+                stock_name NVARCHAR(10) NOT NULL,
+                org_name NTEXT NOT NULL,
+                publish_date DATE NOT NULL,
+                predict_n2y_eps REAL,
+                predict_n2y_pe REAL,
+                predict_ny_eps REAL,
+                predict_ny_pe REAL,
+                predict_ty_eps REAL,
+                predict_ty_pe REAL,
+                predict_ly_eps REAL,
+                predict_ly_pe REAL,
+                industry_name NTEXT,
+                em_rating_value INT,
+                em_rating_name NVARCHAR(10),
+                last_rating_value INT,
+                last_rating_name NVARCHAR(10),
+                authors NTEXT,
+                url NTEXT);""")
+        execute(query, f"""
+            INSERT INTO study_reports_new (id, {columns})
+            SELECT rowid, {columns} FROM study_reports;""")
+        # 旧表的索引和触发器随表一起删除
+        execute(query, "DROP TABLE study_reports;")
+        execute(query, "ALTER TABLE study_reports_new RENAME TO study_reports;")
+        execute(query, """
+            CREATE INDEX IF NOT EXISTS idx_study_reports_stock_date
+            ON study_reports (stock_code, publish_date);""")
+        execute(query, """
+            CREATE INDEX IF NOT EXISTS idx_study_reports_date
+            ON study_reports (publish_date);""")
+        execute(query, """
+            CREATE INDEX IF NOT EXISTS idx_study_reports_stock_org
+            ON study_reports (stock_code, org_name);""")
+
+    execute(query, """
+        CREATE VIRTUAL TABLE study_reports_fts USING fts5(
+            title, org_name, authors, industry_name,
+            content='study_reports', content_rowid='id', tokenize='trigram');""")
+    for trigger in ["study_reports_fts_insert", "study_reports_fts_delete", "study_reports_fts_update"]:
+        execute(query, f"DROP TRIGGER IF EXISTS {trigger};")
+    execute(query, """
+        CREATE TRIGGER study_reports_fts_insert AFTER INSERT ON study_reports BEGIN
+            INSERT INTO study_reports_fts (rowid, title, org_name, authors, industry_name)
+            VALUES (new.id, new.title, new.org_name, new.authors, new.industry_name);
+        END;""")
+    execute(query, """
+        CREATE TRIGGER study_reports_fts_delete AFTER DELETE ON study_reports BEGIN
+            INSERT INTO study_reports_fts (study_reports_fts, rowid, title, org_name, authors, industry_name)
+            VALUES ('delete', old.id, old.title, old.org_name, old.authors, old.industry_name);
+        END;""")
+    execute(query, """
+        CREATE TRIGGER study_reports_fts_update
+        AFTER UPDATE OF title, org_name, authors, industry_name ON study_reports BEGIN
+            INSERT INTO study_reports_fts (study_reports_fts, rowid, title, org_name, authors, industry_name)
+            VALUES ('delete', old.id, old.title, old.org_name, old.authors, old.industry_name);
+            INSERT INTO study_reports_fts (rowid, title, org_name, authors, industry_name)
+            VALUES (new.id, new.title, new.org_name, new.authors, new.industry_name);
+        END;""")
+    execute(query, "INSERT INTO study_reports_fts (study_reports_fts) VALUES ('rebuild');")
+    create_study_report_consensus_triggers(query)
+
+
+def add_deferred_fts(query):
+    """
+    version 10: insert_bulk 插入大批数据时，逐行更新全文索引占了大部分时间。
+    fts_deferred 中有表名时，这个表的插入触发器不更新全文索引，
+    由 insert_bulk 在同一个事务中一次写入新行的索引
+    """
+    execute(query, """
+        CREATE TABLE IF NOT EXISTS fts_deferred (
+            name VARCHAR(20) PRIMARY KEY NOT NULL);""")
+    execute(query, "DROP TRIGGER IF EXISTS announcements_fts_insert;")
+    execute(query, """
+        CREATE TRIGGER announcements_fts_insert AFTER INSERT ON announcements
+        WHEN NOT EXISTS (SELECT 1 FROM fts_deferred WHERE name = 'announcements') BEGIN
+            INSERT INTO announcements_fts (rowid, title) VALUES (new.ann_id, new.title);
+        END;""")
+    execute(query, "DROP TRIGGER IF EXISTS study_reports_fts_insert;")
+    execute(query, """
+        CREATE TRIGGER study_reports_fts_insert AFTER INSERT ON study_reports
+        WHEN NOT EXISTS (SELECT 1 FROM fts_deferred WHERE name = 'study_reports') BEGIN
+            INSERT INTO study_reports_fts (rowid, title, org_name, authors, industry_name)
+            VALUES (new.id, new.title, new.org_name, new.authors, new.industry_name);
+        END;""")
+
+
+# 第 i 个迁移把数据库从版本 i 升级到版本 i+1
+MIGRATIONS = [
+    add_study_report_url_and_indexes,
+    add_announcement_page_index,
+    add_announcement_sync_state,
+    add_documents,
+    add_full_text_index,
+    add_document_pages,
+    add_study_report_consensus,
+    add_quotes,
+    add_study_report_id,
+    add_deferred_fts,
+]
+
+
+def migrate(database):
+    """upgrade the database to the latest version in place"""
+    version = get_user_version(database)
+    query = QSqlQuery(database)
+
+    for new_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        database.transaction()
+        try:
+            migration(query)
+            execute(query, f"PRAGMA user_version = {new_version};")
+        except MigrationError as e:
+            database.rollback()
+            print(f"Unable to migrate database to version {new_version}: ", e)
+            sys.exit(1)
+        database.commit()
+        print(f"Database migrated to version {new_version}")
@@ -0,0 +1,315 @@
+"""
+models.py
+界面中表格使用的 model
+"""
+import math
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt6.QtGui import QColor, QFont
+from statementstore import format_value
+
+
+RISE_COLOR = QColor("#ff4343")
+FALL_COLOR = QColor("#07a168")
+
+
+def format_number(value, fmt):
+    """format a quote value, nan is shown as --"""
+    value = float(value)
+    if math.isnan(value):
+        return "--"
+    return fmt.format(value)
+
+
+class StockQuoteModel(QAbstractTableModel):
+    """
+    自选股行情 model，按股票代码索引每一行。
+    每次刷新只对发生变化的单元格发出 dataChanged，
+    只有自选股列表变化时才插入或删除行。
+    """
+    header_labels = ["名称", "代码", "最新", "涨幅", "涨跌", "市盈TTM", "市净", "总市值"]
+    alignments = [Qt.AlignmentFlag.AlignCenter] * 2 + \
+        [Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter] * 6
+
+    def __init__(self, codes=None, parent=None):
+        super().__init__(parent)
+        self.codes = []
+        # code -> 格式化好的 8 个单元格文本
+        self.cells = {}
+        # code -> 是否上涨，决定整行的颜色
+        self.rising = {}
+        if codes:
+            self.set_watchlist(codes)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.codes)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.header_labels)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.header_labels[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        code = self.codes[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.cells[code][index.column()]
+        if role == Qt.ItemDataRole.TextAlignmentRole:
+            return self.alignments[index.column()]
+        if role == Qt.ItemDataRole.ForegroundRole:
+            rising = self.rising.get(code)
+            if rising is None:
+                return None
+            return RISE_COLOR if rising else FALL_COLOR
+        return None
+
+    def code(self, row):
+        """return the stock code of a row"""
+        return self.codes[row]
+
+    def set_watchlist(self, codes):
+        """
+        sync rows with the watchlist: remove rows of deleted codes
+        and append rows for new codes, keep the other rows untouched
+        """
+        wanted = set(codes)
+        for row in range(len(self.codes) - 1, -1, -1):
+            code = self.codes[row]
+            if code not in wanted:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.codes[row]
+                del self.cells[code]
+                self.rising.pop(code, None)
+                self.endRemoveRows()
+
+        new_codes = [code for code in dict.fromkeys(codes) if code not in self.cells]
+        if new_codes:
+            first = len(self.codes)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_codes) - 1)
+            for code in new_codes:
+                self.codes.append(code)
+                self.cells[code] = ("", code, "", "", "", "", "", "")
+            self.endInsertRows()
+
+    @staticmethod
+    def format_quote(data):
+        """format a quote dict returned by quotes.get_market_data_many"""
+        return (
+            data["Name"],
+            data["Code"],
+            format_number(data["LatestPrice"], "{:.2f}"),
+            format_number(data["ChangeRate"], "{:.2f}%"),
+            format_number(data["ChangeAmount"], "{:.2f}"),
+            format_number(data["PETTM"], "{:.1f}"),
+            format_number(data["PB"], "{:.1f}"),
+            format_number(data["MarketValue"], "{:.0f}亿"))
+
+    def update_quotes(self, stocks_data):
+        """
+        update rows with new quotes, emit dataChanged only for changed cells.
+        quotes of codes not in the watchlist are ignored.
+        """
+        rows = {code: row for row, code in enumerate(self.codes)}
+        for data in stocks_data:
+            code = data["Code"]
+            row = rows.get(code)
+            if row is None:
+                continue
+
+            cells = self.format_quote(data)
+            rising = float(data["ChangeRate"]) > 0
+            old_cells = self.cells[code]
+            if rising != self.rising.get(code):
+                # 涨跌方向变了，整行颜色都要更新
+                changed = list(range(len(cells)))
+            else:
+                changed = [i for i, cell in enumerate(cells) if cell != old_cells[i]]
+            if not changed:
+                continue
+
+            self.cells[code] = cells
+            self.rising[code] = rising
+            self.dataChanged.emit(self.index(row, changed[0]), self.index(row, changed[-1]))
+
+
+class AnnouncementTableModel(QAbstractTableModel):
+    """
+    公告列表 model，按需分页从数据库读取公告。
+    视图滚动到底部附近时会调用 fetchMore，每次读取一页，
+    所以打开页面的时间与数据库中公告的数量无关。
+    """
+    header_labels = ["序号", "公告标题", "公告时间"]
+
+    def __init__(self, fetch_page, page_size, parent=None):
+        """
+        fetch_page(after, limit) returns a list of createdb.Announcement
+        ordered by (ann_date, ann_id) descending, see
+        AnnouncementDatabase.query_announcements_page
+        """
+        super().__init__(parent)
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.announcements = []
+        self.exhausted = False
+        self.unread_font = QFont()
+        self.unread_font.setBold(True)
+        self.read_font = QFont()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.announcements)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.header_labels)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.header_labels[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        ann = self.announcements[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == 0:
+                return f"{index.row() + 1}"
+            if column == 1:
+                # 搜索结果显示标出了匹配词的摘要
+                return f"{ann.name}: {ann.snippet or ann.title}"
+            return str(ann.ann_date)
+        if role == Qt.ItemDataRole.TextAlignmentRole and column == 0:
+            return Qt.AlignmentFlag.AlignCenter
+        if role == Qt.ItemDataRole.FontRole and column == 1:
+            if ann.state == "UNREAD":
+                return self.unread_font
+            return self.read_font
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        after = None
+        if self.announcements:
+            last = self.announcements[-1]
+            after = (last.ann_date, last.ann_id)
+        page = self.fetch_page(after, self.page_size)
+        if len(page) < self.page_size:
+            self.exhausted = True
+        if not page:
+            return
+
+        first = len(self.announcements)
+        self.beginInsertRows(QModelIndex(), first, first + len(page) - 1)
+        self.announcements.extend(page)
+        self.endInsertRows()
+
+    def reload(self):
+        """drop the loaded rows, the view fetches the first page again"""
+        self.beginResetModel()
+        self.announcements = []
+        self.exhausted = False
+        self.endResetModel()
+
+    def set_fetch_page(self, fetch_page):
+        """read the rows from another source, e.g. search results"""
+        self.fetch_page = fetch_page
+        self.reload()
+
+    @staticmethod
+    def sort_key(ann):
+        return (ann.ann_date, ann.ann_id)
+
+    def merge_announcements(self, announcements):
+        """
+        insert new announcements at their sorted positions. announcements
+        older than the loaded rows are skipped, fetchMore reads them later.
+        """
+        loaded_ids = {ann.ann_id for ann in self.announcements}
+        for ann in sorted(announcements, key=self.sort_key, reverse=True):
+            if ann.ann_id in loaded_ids:
+                continue
+            key = self.sort_key(ann)
+            row = 0
+            while row < len(self.announcements) and self.sort_key(self.announcements[row]) > key:
+                row += 1
+            if row == len(self.announcements) and not self.exhausted:
+                continue
+
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.announcements.insert(row, ann)
+            self.endInsertRows()
+            loaded_ids.add(ann.ann_id)
+            # 序号列跟着变化
+            self.dataChanged.emit(self.index(row, 0), self.index(len(self.announcements) - 1, 0))
+
+    def announcement(self, row):
+        """return the Announcement of a row"""
+        return self.announcements[row]
+
+    def set_state(self, row, state):
+        """update the state of a row after it is changed in the database"""
+        self.announcements[row] = self.announcements[row]._replace(state=state)
+        index = self.index(row, 1)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.FontRole])
+
+    def remove_row(self, row):
+        """remove a row after the announcement is deleted"""
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.announcements[row]
+        self.endRemoveRows()
+        # 序号列跟着变化
+        if row < len(self.announcements):
+            self.dataChanged.emit(self.index(row, 0), self.index(len(self.announcements) - 1, 0))
+
+
+class FinancialStatementModel(QAbstractTableModel):
+    """
+    财务报表 model，直接读取 statementstore.Statement 的矩阵，
+    只有视图需要显示的单元格才会被格式化
+    """
+    def __init__(self, statement, parent=None):
+        super().__init__(parent)
+        self.statement = statement
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.statement.items)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.statement.periods)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        if orientation == Qt.Orientation.Horizontal:
+            return self.statement.periods[section]
+        return self.statement.items[section]
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return format_value(float(self.statement.values[index.row(), index.column()]))
+        if role == Qt.ItemDataRole.TextAlignmentRole:
+            return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        return None
@@ -0,0 +1,92 @@
+"""
+pdftext.py
+提取本地缓存的 pdf 文件的文本，按页写入全文索引
+
+解析 pdf 主要消耗 CPU，所以在进程池中执行，每个任务处理一个文件；
+文件按内容 hash 保存，内容变化的文件就是新文件，已经提取过的文件不会重复处理。
+每个文件的页面文本和完成状态在同一个事务中写入，中断后重新运行即可继续。
+
+用法: python pdftext.py
+"""
+import os
+import sys
+import time
+import multiprocessing
+import concurrent.futures
+
+
+# 进程池大小
+PDF_WORKERS = os.cpu_count() or 1
+
+
+def extract_pdf(path):
+    """return the text of every page of a pdf file, runs in a worker process"""
+    # 只在子进程中导入，界面启动时不需要加载 pymupdf
+    import pymupdf
+    with pymupdf.open(path) as pdf:
+        return [page.get_text() for page in pdf]
+
+
+def index_documents(db, store, max_workers=PDF_WORKERS, on_progress=None):
+    """
+    extract the text of the stored files not indexed yet in a process pool.
+    on_progress(done, total) is called after every file.
+    return a dict of the number of files, pages, bytes and seconds
+    """
+    pending = [(hash, size) for hash, size in db.query_unindexed_documents()
+               if os.path.exists(store.object_path(hash))]
+    stats = {"files": 0, "failed": 0, "pages": 0, "bytes": 0, "seconds": 0.0}
+    if not pending:
+        return stats
+
+    start = time.perf_counter()
+    writes = []
+    # spawn 启动的子进程不会继承 Qt 和数据库连接的状态；子进程会重新导入 __main__ 模块，
+    # 所以调用者（announce.py 的 open_stores）不能在导入时打开数据库
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        futures = {executor.submit(extract_pdf, store.object_path(hash)): (hash, size)
+                   for hash, size in pending}
+        for future in concurrent.futures.as_completed(futures):
+            hash, size = futures[future]
+            try:
+                pages = future.result()
+                error = None
+            except Exception as e:
+                # 损坏或加密的文件记录下原因，以后不再重试
+                print(f"Unable to extract the text of {store.object_path(hash)}: ", e)
+                pages = []
+                error = str(e)
+                stats["failed"] += 1
+            writes.append(db.insert_document_pages(hash, size, pages, error))
+
+            stats["files"] += 1
+            stats["pages"] += len(pages)
+            stats["bytes"] += size
+            if on_progress is not None:
+                on_progress(stats["files"], len(pending))
+
+    for write in writes:
+        write.result()
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def format_stats(stats):
+    """throughput of index_documents for printing"""
+    seconds = max(stats["seconds"], 1e-9)
+    mb = stats["bytes"] / 1024 / 1024
+    return (f'{stats["files"]} files ({stats["failed"]} failed), {stats["pages"]} pages, {mb:.1f} MB '
+            f'in {stats["seconds"]:.1f}s: {stats["pages"] / seconds:.1f} pages/s, {mb / seconds:.2f} MB/s')
+
+
+if __name__ == "__main__":
+    from PyQt6.QtCore import QCoreApplication
+    import createdb
+    import docstore
+
+    app = QCoreApplication(sys.argv)
+    db = createdb.AnnouncementDatabase()
+    store = docstore.DocumentStore(db)
+    print(format_stats(index_documents(db, store)))
+    db.close()
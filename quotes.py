@@ -0,0 +1,136 @@
+"""
+quotes.py
+批量获取自选股行情
+"""
+import concurrent.futures
+import stockapi
+import httpclient
+
+
+# 东方财富的批量行情接口，一次请求可以返回多只股票的行情
+BATCH_QUOTE_URL = "https://push2.eastmoney.com/api/qt/ulist.np/get"
+# 每次请求包含的股票数量
+BATCH_SIZE = 50
+# 线程池大小
+MAX_WORKERS = 8
+TIMEOUT = 5
+
+# f12 代码, f14 名称, f2 最新价, f3 涨跌幅, f4 涨跌额, f115 市盈率TTM, f23 市净率, f20 总市值
+BATCH_QUOTE_FIELDS = "f12,f14,f2,f3,f4,f115,f23,f20"
+
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+def get_secid(code):
+    """
+    return the eastmoney secid of an A share code, or None
+    if the code can not be requested in a batch
+    """
+    if len(code) != 6 or not code.isdigit():
+        return None
+    if code[0] in "569":
+        return f"1.{code}"
+    return f"0.{code}"
+
+
+def to_float(value):
+    """停牌等情况下接口返回 "-"，统一转成 nan"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def parse_quote(item):
+    """convert a batch quote item to the dict returned by stockapi.get_market_data"""
+    return {
+        "Code": item["f12"],
+        "Name": item["f14"],
+        "LatestPrice": to_float(item["f2"]),
+        "ChangeRate": to_float(item["f3"]),
+        "ChangeAmount": to_float(item["f4"]),
+        "PETTM": to_float(item["f115"]),
+        "PB": to_float(item["f23"]),
+        # 接口返回的单位是元，界面上显示的是亿
+        "MarketValue": to_float(item["f20"]) / 1e8}
+
+
+def get_market_data_batch(codes):
+    """
+    get market data of many A share codes in one request,
+    return a dict keyed by code
+    """
+    params = {
+        "fltt": 2,
+        "invt": 2,
+        "fields": BATCH_QUOTE_FIELDS,
+        "secids": ",".join(get_secid(code) for code in codes)}
+    # 批量请求使用共享 client 中该域名的 keep-alive 连接池
+    response = httpclient.get(BATCH_QUOTE_URL, params=params, timeout=TIMEOUT, max_retries=1)
+    response.raise_for_status()
+    data = response.json().get("data") or {}
+
+    quotes = {}
+    for item in data.get("diff") or []:
+        quote = parse_quote(item)
+        quotes[quote["Code"]] = quote
+    return quotes
+
+
+def get_market_data_single(codes):
+    """fallback: get market data one code per request, return a dict keyed by code"""
+    quotes = {}
+    for code in codes:
+        data = stockapi.get_market_data(code)
+        if data != {}:
+            quotes[code] = data
+    return quotes
+
+
+def get_market_data_many(codes):
+    """
+    get market data of all codes, keep the order of codes.
+
+    A 股按 BATCH_SIZE 分批，每批一个请求；不能批量请求的代码（港股、美股）
+    或者批量请求失败的那一批，改为在线程池里逐只请求。
+    所有请求都在同一个有界线程池里并发执行。
+    """
+    batch_codes = [code for code in codes if get_secid(code) is not None]
+    single_codes = [code for code in codes if get_secid(code) is None]
+
+    # future -> 批量请求的代码，逐只请求的 future 对应 None
+    futures = {}
+    for i in range(0, len(batch_codes), BATCH_SIZE):
+        batch = batch_codes[i:i + BATCH_SIZE]
+        futures[executor.submit(get_market_data_batch, batch)] = batch
+    for code in single_codes:
+        futures[executor.submit(get_market_data_single, [code])] = None
+
+    quotes = {}
+    fallback_futures = []
+    for future in concurrent.futures.as_completed(futures):
+        batch = futures[future]
+        try:
+            quotes.update(future.result())
+        except Exception as e:
+            # 任何异常都不能传出去，否则 UpdateStockWorker 的循环会结束，行情不再刷新
+            if batch is None:
+                print("Some exception occured in get_market_data_single: ", e)
+                continue
+            print("Batch quote request failed, fall back to single requests: ", e)
+            for code in batch:
+                fallback_futures.append(executor.submit(get_market_data_single, [code]))
+
+    for future in fallback_futures:
+        try:
+            quotes.update(future.result())
+        except Exception as e:
+            print("Some exception occured in get_market_data_single: ", e)
+
+    return [quotes[code] for code in codes if code in quotes]
+
+
+if __name__ == "__main__":
+    for quote in get_market_data_many(["600519", "002594", "300760", "601166"]):
+        print(quote)
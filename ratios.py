@@ -0,0 +1,192 @@
+"""
+ratios.py
+用 numpy 批量计算财务指标
+
+把多只股票的利润表、资产负债表、现金流量表中用到的项目读入一个
+(股票 x 季度 x 项目) 的数组，季度按日期对齐，缺失的数据是 nan；
+每个指标都是对整个数组的一次运算，不按股票循环。
+
+利润表和现金流量表的数据是年初至报告期末的累计值，
+单季度的值 = 本期累计值 - 上一季度累计值（一季度就是累计值）。
+"""
+import datetime
+import numpy as np
+
+
+# 指标用到的项目：名称 -> (报表, 报表中的项目名称)
+ITEMS = {
+    "revenue": ("lrb", "营业总收入(万元)"),
+    "operating_revenue": ("lrb", "营业收入(万元)"),
+    "operating_cost": ("lrb", "营业成本(万元)"),
+    "selling_expense": ("lrb", "销售费用(万元)"),
+    "admin_expense": ("lrb", "管理费用(万元)"),
+    "financial_expense": ("lrb", "财务费用(万元)"),
+    "rd_expense": ("lrb", "研发费用(万元)"),
+    "net_profit": ("lrb", "净利润(万元)"),
+    "parent_net_profit": ("lrb", "归属于母公司所有者的净利润(万元)"),
+    "total_assets": ("zcfzb", "资产总计(万元)"),
+    "total_liabilities": ("zcfzb", "负债合计(万元)"),
+    "current_assets": ("zcfzb", "流动资产合计(万元)"),
+    "current_liabilities": ("zcfzb", "流动负债合计(万元)"),
+    "parent_equity": ("zcfzb", "归属于母公司股东权益合计(万元)"),
+    "operating_cash_flow": ("xjllb", "经营活动产生的现金流量净额(万元)"),
+}
+# 这些报表的数据是年初至今的累计值
+CUMULATIVE_CATEGORIES = ("lrb", "xjllb")
+
+
+def quarter_number(period):
+    """'2022-03-31' -> the number of quarters since year 0"""
+    date = datetime.date.fromisoformat(period)
+    return date.year * 4 + (date.month - 1) // 3
+
+
+def quarter_period(number):
+    """the inverse of quarter_number"""
+    year, quarter = divmod(number, 4)
+    month = quarter * 3 + 3
+    day = 31 if month in (3, 12) else 30
+    return f"{year}-{month:02d}-{day}"
+
+
+class Panel:
+    """
+    values[stock, quarter, item]，quarters 从旧到新连续排列，
+    期间没有报告的季度也有一列，值为 nan
+    """
+    def __init__(self, codes, periods, names, values):
+        self.codes = codes
+        self.periods = periods
+        self.names = names
+        self.values = values
+        self.item_index = {name: i for i, name in enumerate(names)}
+        # 每一列是一年中的第几个季度，1 ~ 4
+        self.quarters = np.array([(quarter_number(period) % 4) + 1 for period in periods])
+
+    def item(self, name):
+        """the (stock x quarter) array of an item"""
+        return self.values[:, :, self.item_index[name]]
+
+
+def load_panel(store, codes=None, items=ITEMS):
+    """read the items of the stocks from a StatementStore into a Panel"""
+    if codes is None:
+        codes = sorted(set(store.codes("lrb")) | set(store.codes("zcfzb")) | set(store.codes("xjllb")))
+    names = list(items)
+
+    statements = {}
+    first = last = None
+    for code in codes:
+        for category in {category for category, _ in items.values()}:
+            statement = store.get(code, category)
+            if statement is None or not statement.periods:
+                continue
+            numbers = np.array([quarter_number(period) for period in statement.periods])
+            statements[(code, category)] = (statement, numbers)
+            first = numbers.min() if first is None else min(first, numbers.min())
+            last = numbers.max() if last is None else max(last, numbers.max())
+    if first is None:
+        return Panel(codes, [], names, np.full((len(codes), 0, len(names)), np.nan))
+
+    periods = [quarter_period(number) for number in range(first, last + 1)]
+    values = np.full((len(codes), len(periods), len(names)), np.nan)
+    for s, code in enumerate(codes):
+        for j, name in enumerate(names):
+            category, item = items[name]
+            if (code, category) not in statements:
+                continue
+            statement, numbers = statements[(code, category)]
+            if item not in statement.items:
+                continue
+            # 只读取这一行
+            row = statement.items.index(item)
+            values[s, numbers - first, j] = statement.values[row]
+    return Panel(codes, periods, names, values)
+
+
+def divide(numerator, denominator):
+    """element-wise division, nan where the denominator is 0 or missing"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = numerator / denominator
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+
+def shift(values, lag):
+    """values of lag quarters before, the first lag columns are nan"""
+    shifted = np.full_like(values, np.nan)
+    if lag < values.shape[1]:
+        shifted[:, lag:] = values[:, :-lag]
+    return shifted
+
+
+def single_quarter(cumulative, quarters):
+    """single quarter values from year-to-date values"""
+    result = cumulative - shift(cumulative, 1)
+    first_quarter = quarters == 1
+    result[:, first_quarter] = cumulative[:, first_quarter]
+    return result
+
+
+def ttm(quarterly):
+    """trailing twelve months: the sum of the last 4 single quarters, nan if one is missing"""
+    result = np.full_like(quarterly, np.nan)
+    if quarterly.shape[1] >= 4:
+        windows = np.lib.stride_tricks.sliding_window_view(quarterly, 4, axis=1)
+        result[:, 3:] = windows.sum(axis=2)
+    return result
+
+
+def growth(values, lag):
+    """growth against lag quarters before, 4 is YoY and 1 is QoQ"""
+    previous = shift(values, lag)
+    return divide(values - previous, np.abs(previous))
+
+
+def average(values, lag=4):
+    """average of the value now and lag quarters before, for balance sheet items"""
+    return (values + shift(values, lag)) / 2
+
+
+def compute_ratios(panel):
+    """
+    return {ratio name: (stock x quarter) array}. 流量项目先换算成单季度和 TTM，
+    资产负债表项目用期初期末平均值
+    """
+    quarters = panel.quarters
+    quarterly = {}
+    trailing = {}
+    for name, (category, _) in ITEMS.items():
+        if category in CUMULATIVE_CATEGORIES and name in panel.item_index:
+            quarterly[name] = single_quarter(panel.item(name), quarters)
+            trailing[name] = ttm(quarterly[name])
+
+    total_assets = panel.item("total_assets")
+    parent_equity = panel.item("parent_equity")
+    gross_profit_q = quarterly["operating_revenue"] - quarterly["operating_cost"]
+    gross_profit_ttm = trailing["operating_revenue"] - trailing["operating_cost"]
+    expenses_ttm = trailing["selling_expense"] + trailing["admin_expense"] + trailing["financial_expense"]
+
+    return {
+        "revenue_ttm": trailing["revenue"],
+        "net_profit_ttm": trailing["parent_net_profit"],
+        "operating_cash_flow_ttm": trailing["operating_cash_flow"],
+        "revenue_yoy": growth(trailing["revenue"], 4),
+        "net_profit_yoy": growth(trailing["parent_net_profit"], 4),
+        "revenue_quarter_yoy": growth(quarterly["revenue"], 4),
+        "net_profit_quarter_yoy": growth(quarterly["parent_net_profit"], 4),
+        "revenue_qoq": growth(quarterly["revenue"], 1),
+        "net_profit_qoq": growth(quarterly["parent_net_profit"], 1),
+        "gross_margin": divide(gross_profit_q, quarterly["operating_revenue"]),
+        "gross_margin_ttm": divide(gross_profit_ttm, trailing["operating_revenue"]),
+        "net_margin_ttm": divide(trailing["net_profit"], trailing["revenue"]),
+        "expense_ratio_ttm": divide(expenses_ttm, trailing["revenue"]),
+        "rd_ratio_ttm": divide(trailing["rd_expense"], trailing["revenue"]),
+        "roe_ttm": divide(trailing["parent_net_profit"], average(parent_equity)),
+        "roa_ttm": divide(trailing["net_profit"], average(total_assets)),
+        "asset_turnover_ttm": divide(trailing["revenue"], average(total_assets)),
+        "debt_to_assets": divide(panel.item("total_liabilities"), total_assets),
+        "current_ratio": divide(panel.item("current_assets"), panel.item("current_liabilities")),
+        "equity_yoy": growth(parent_equity, 4),
+        "ocf_to_net_profit_ttm": divide(trailing["operating_cash_flow"], trailing["net_profit"]),
+    }
@@ -0,0 +1,195 @@
+"""
+statementcache.py
+财务报表缓存的更新和清理策略
+
+上市公司按季度披露财务报告：一季报（03-31）4 月 30 日前，半年报（06-30）8 月 31 日前，
+三季报（09-30）10 月 31 日前，年报（12-31）次年 4 月 30 日前。
+缓存中的报表已经包含最近一个季度末的数据时，不可能有更新的报表，不需要请求网络；
+最近一个季度的报告还没有出现时，披露期内每天最多检查一次，过了披露截止日每周检查一次。
+"""
+import os
+import glob
+import datetime
+import threading
+import collections
+import stockapi
+import statementstore
+
+
+# 缓存目录的总大小上限
+STATEMENT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# 披露期内和过了截止日后，再次检查新报表的间隔天数
+RECHECK_DAYS = 1
+OVERDUE_RECHECK_DAYS = 7
+# 季度末 (月, 日) -> 披露截止日 (月, 日, 相对季度末的年份)
+DISCLOSURE_DEADLINES = {
+    (3, 31): (4, 30, 0),
+    (6, 30): (8, 31, 0),
+    (9, 30): (10, 31, 0),
+    (12, 31): (4, 30, 1),
+}
+
+
+def latest_quarter_end(today):
+    """the last quarter end on or before today"""
+    for month, day in sorted(DISCLOSURE_DEADLINES, reverse=True):
+        quarter_end = datetime.date(today.year, month, day)
+        if quarter_end <= today:
+            return quarter_end
+    return datetime.date(today.year - 1, 12, 31)
+
+
+def disclosure_deadline(quarter_end):
+    month, day, years = DISCLOSURE_DEADLINES[(quarter_end.month, quarter_end.day)]
+    return datetime.date(quarter_end.year + years, month, day)
+
+
+def is_fresh(newest_period, fetched_at, today):
+    """
+    whether a statement whose newest report date is newest_period, downloaded
+    on fetched_at, can be used without asking the server on today
+    """
+    quarter_end = latest_quarter_end(today)
+    if newest_period >= quarter_end:
+        # 不可能有更新的报表
+        return True
+    if today > disclosure_deadline(quarter_end):
+        recheck_days = OVERDUE_RECHECK_DAYS
+    else:
+        recheck_days = RECHECK_DAYS
+    return (today - fetched_at).days < recheck_days
+
+
+class StatementCache:
+    """
+    get financial statements from a StatementStore, download them with
+    stockapi.get_financial_statement only when a newer report can exist
+    """
+    def __init__(self, store, max_bytes=STATEMENT_CACHE_MAX_BYTES, csv_directory="cache"):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.csv_directory = csv_directory
+        self.lock = threading.Lock()
+        # 同一时间只有一个线程清理缓存
+        self.evict_lock = threading.Lock()
+        # hits 命中, misses 缓存中没有, stale 有但可能过期而重新下载, unchanged 重新下载后没有新数据,
+        # failed 重新下载失败而使用缓存中的报表
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "unchanged": 0, "failed": 0}
+        # "{code}_{category}" -> csv 文件的字节数，第一次使用时扫描一次目录，之后随下载和清理更新
+        self.csv_sizes = None
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        """the counters and the share of requests served without the network"""
+        with self.lock:
+            stats = dict(self.counters)
+        requests = stats["hits"] + stats["misses"] + stats["stale"]
+        stats["hit_rate"] = stats["hits"] / requests if requests else 0.0
+        stats["bytes"] = self.total_bytes()
+        return stats
+
+    def get(self, code, category, today=None):
+        """
+        return the Statement of a stock, download it if needed. 下载失败时
+        如果缓存中有旧的报表就返回旧的，没有时抛出异常
+        """
+        today = today or datetime.date.today()
+        meta = self.store.meta(code, category)
+        if meta is not None:
+            newest_period = datetime.date.fromisoformat(meta["periods"][0]) if meta["periods"] else datetime.date.min
+            if is_fresh(newest_period, datetime.date.fromisoformat(meta["fetched_at"]), today):
+                self.count("hits")
+                return self.store.get(code, category)
+            self.count("stale")
+        else:
+            self.count("misses")
+
+        old_periods = None if meta is None else meta["periods"]
+        try:
+            rows = stockapi.get_financial_statement(code, category)
+        except Exception as e:
+            if meta is None:
+                raise
+            print(f"Unable to refresh the statement {code}_{category}, use the cached one: ", e)
+            self.count("failed")
+            return self.store.get(code, category)
+        statement = statementstore.parse_statement(rows)
+        self.store.put(code, category, statement, today.isoformat())
+        if old_periods == statement.periods:
+            self.count("unchanged")
+        self.collapse_snapshots(code, category)
+        if self.total_bytes() > self.max_bytes:
+            self.evict(keep=(code, category))
+        return self.store.get(code, category)
+
+    def snapshots(self, code, category):
+        return sorted(glob.glob(os.path.join(self.csv_directory, f"{code}_{category}_*.csv")))
+
+    def collapse_snapshots(self, code, category):
+        """
+        stockapi 每次下载都保存一个 {code}_{category}_{date}.csv，
+        最新的文件已经包含以前所有的报告期，删除旧的文件
+        """
+        paths = self.snapshots(code, category)
+        for path in paths[:-1]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Unable to remove {path}: ", e)
+        size = os.path.getsize(paths[-1]) if paths else 0
+        self.csv_bytes()
+        with self.lock:
+            self.csv_sizes[f"{code}_{category}"] = size
+
+    def csv_bytes(self):
+        """bytes of the csv snapshots, the directory is only scanned the first time"""
+        with self.lock:
+            if self.csv_sizes is not None:
+                return sum(self.csv_sizes.values())
+        csv_sizes = collections.Counter()
+        for path in glob.glob(os.path.join(self.csv_directory, "*_*_*.csv")):
+            code, category, _ = os.path.basename(path).split("_", 2)
+            csv_sizes[f"{code}_{category}"] += os.path.getsize(path)
+        with self.lock:
+            if self.csv_sizes is None:
+                self.csv_sizes = dict(csv_sizes)
+            return sum(self.csv_sizes.values())
+
+    def total_bytes(self):
+        """bytes of the csv snapshots and the stored statements, without scanning the files"""
+        return self.csv_bytes() + self.store.total_bytes()
+
+    def evict(self, keep=None):
+        """remove the least recently used statements until the cache fits in max_bytes"""
+        with self.evict_lock:
+            total = self.total_bytes()
+            if total <= self.max_bytes:
+                return
+            metas = {key: self.store.meta(*key.rsplit("_", 1)) for key in self.store.keys()}
+            keys = sorted((key for key in metas if metas[key] is not None),
+                          key=lambda key: metas[key].get("accessed_at", ""))
+            for key in keys:
+                if total <= self.max_bytes:
+                    break
+                code, category = key.rsplit("_", 1)
+                if (code, category) == keep:
+                    continue
+                total -= self.store.size(code, category)
+                for path in self.snapshots(code, category):
+                    try:
+                        total -= os.path.getsize(path)
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"Unable to remove {path}: ", e)
+                with self.lock:
+                    self.csv_sizes.pop(key, None)
+                self.store.remove(code, category)
+
+
+def format_stats(stats):
+    return (f'statement cache: {stats["hits"]} hits, {stats["misses"]} misses, {stats["stale"]} stale '
+            f'({stats["unchanged"]} unchanged, {stats["failed"]} failed), hit rate {stats["hit_rate"]:.0%}, '
+            f'{stats["bytes"] / 1024 / 1024:.1f} MB')
@@ -0,0 +1,303 @@
+"""
+statementstore.py
+财务报表的列式存储
+
+每只股票的每种报表保存为一个 float64 矩阵（行是报表项目，列是报告日期），
+用 numpy 的 .npy 格式保存，读取时用内存映射打开，不需要解析文本。
+报告日期和项目名称保存在每个矩阵旁边的 .json 中，
+所以可以只读取所有股票的某一行，而不需要读取整个文件。
+"""
+import os
+import csv
+import glob
+import json
+import datetime
+import threading
+import collections
+import numpy as np
+
+
+STATEMENT_STORE_PATH = "cache/store"
+# 以前的版本把所有报表的信息保存在一个索引文件中，打开时拆分成每个报表一个 .json
+INDEX_FILE_NAME = "index.json"
+# zcfzb 资产负债表, lrb 利润表, xjllb 现金流量表
+CATEGORIES = ("zcfzb", "lrb", "xjllb")
+# 报表中缺失的数据
+MISSING_VALUE = "--"
+
+# items 项目名称, periods 报告日期（从新到旧）, values 项目数 x 日期数的矩阵
+Statement = collections.namedtuple("Statement", ["items", "periods", "values"])
+
+
+def to_value(text):
+    """convert a cell of the statement to float, -- and bad values are nan"""
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def format_value(value):
+    """format a value like the original statement, nan is shown as --"""
+    if np.isnan(value):
+        return MISSING_VALUE
+    if value.is_integer():
+        return f"{value:.0f}"
+    return str(value)
+
+
+def parse_statement(rows):
+    """
+    parse the rows returned by stockapi.get_financial_statement, the first
+    row is 报告日期 and the dates, every other row is an item and its values.
+    return a Statement with a float64 matrix
+    """
+    rows = [list(row) for row in rows if row]
+    # 有些行末尾带逗号，去掉多出来的空列
+    for row in rows:
+        while row and row[-1].strip() == "":
+            row.pop()
+    periods = [period.strip() for period in rows[0][1:]]
+    items = [row[0].strip() for row in rows[1:]]
+    values = np.full((len(items), len(periods)), np.nan)
+    for i, row in enumerate(rows[1:]):
+        cells = row[1:len(periods) + 1]
+        values[i, :len(cells)] = [to_value(cell) for cell in cells]
+    return Statement(items, periods, values)
+
+
+def statement_rows(statement):
+    """convert a Statement back to rows of strings"""
+    rows = [["报告日期"] + list(statement.periods)]
+    for item, values in zip(statement.items, statement.values):
+        rows.append([item] + [format_value(value) for value in values])
+    return rows
+
+
+class StatementStore:
+    """
+    columnar store of financial statements.
+
+    每个 (股票, 报表) 的数值保存在 {code}_{category}.npy 中，报告日期、项目名称
+    和下载日期保存在同名的 .json 中。两个文件都先写临时文件再替换，
+    每次保存只写这一个报表的文件，界面和 ingest.py 可以同时使用同一个目录。
+    """
+    def __init__(self, directory=STATEMENT_STORE_PATH):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # "{code}_{category}" -> {"periods": [...], "items": [item name],
+        #                         "fetched_at": 下载日期, "accessed_at": 最近读取日期}
+        self.statements = {}
+        # "{code}_{category}" -> 读取 .json 时文件的 (修改时间, 大小)，其它进程更新后重新读取
+        self.versions = {}
+        # "{code}_{category}" -> .npy 文件的字节数
+        self.sizes = {}
+        # "{code}_{category}" -> 内存映射的矩阵
+        self.matrices = {}
+        # total_bytes 第一次调用时才读取所有报表的信息
+        self.loaded = False
+        self.import_index()
+
+    def matrix_path(self, code, category):
+        return os.path.join(self.directory, f"{code}_{category}.npy")
+
+    def meta_path(self, code, category):
+        return os.path.join(self.directory, f"{code}_{category}.json")
+
+    def meta_version(self, code, category):
+        """(modification time, size) of the .json of a statement, None if it is missing"""
+        try:
+            stat = os.stat(self.meta_path(code, category))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def write_meta(self, code, category, meta):
+        """replace the .json of a statement, return its version"""
+        path = self.meta_path(code, category)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(meta, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return self.meta_version(code, category)
+
+    def read_meta(self, code, category):
+        """read the .json of a statement, return (meta, version), meta is None if it is missing"""
+        version = self.meta_version(code, category)
+        try:
+            with open(self.meta_path(code, category), encoding="utf-8") as file:
+                return json.load(file), version
+        except (OSError, ValueError):
+            return None, None
+
+    def import_index(self):
+        """split the index.json written by older versions into one .json per statement"""
+        path = os.path.join(self.directory, INDEX_FILE_NAME)
+        try:
+            with open(path, encoding="utf-8") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return
+        items = index.get("items", {})
+        for key, meta in index.get("statements", {}).items():
+            code, category = key.rsplit("_", 1)
+            meta["items"] = [items[category][item_id] for item_id in meta["items"]]
+            self.write_meta(code, category, meta)
+        os.remove(path)
+
+    def keys(self):
+        """
+        the keys "{code}_{category}" of the stored statements, read from the
+        directory so the statements saved by other processes are included
+        """
+        keys = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            if key.rsplit("_", 1)[-1] in CATEGORIES:
+                keys.append(key)
+        return keys
+
+    def is_empty(self):
+        return not self.keys()
+
+    def meta(self, code, category):
+        """
+        the metadata of a statement, None if it is not stored. 文件被其它进程
+        修改或删除时重新读取，每次调用只检查一次文件的修改时间
+        """
+        key = f"{code}_{category}"
+        version = self.meta_version(code, category)
+        with self.lock:
+            if version is not None and self.versions.get(key) == version:
+                return self.statements[key]
+        meta, version = self.read_meta(code, category)
+        with self.lock:
+            # 矩阵文件可能也已经被替换
+            self.matrices.pop(key, None)
+            if meta is None:
+                self.statements.pop(key, None)
+                self.versions.pop(key, None)
+                self.sizes.pop(key, None)
+                return None
+            self.statements[key] = meta
+            self.versions[key] = version
+            self.sizes[key] = self.size(code, category)
+            return meta
+
+    def put(self, code, category, statement, fetched_at=None):
+        """
+        save a Statement, or the rows returned by stockapi, replace the old one.
+        fetched_at is the date it was downloaded, today by default
+        """
+        if not isinstance(statement, Statement):
+            statement = parse_statement(statement)
+        key = f"{code}_{category}"
+        path = self.matrix_path(code, category)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.save(file, np.ascontiguousarray(statement.values, dtype=np.float64))
+        today = datetime.date.today().isoformat()
+        meta = {
+            "periods": list(statement.periods),
+            "items": list(statement.items),
+            "fetched_at": fetched_at or today,
+            "accessed_at": today}
+        with self.lock:
+            # Windows 下被映射的文件不能替换，先关闭映射
+            self.matrices.pop(key, None)
+            os.replace(tmp_path, path)
+            self.versions[key] = self.write_meta(code, category, meta)
+            self.statements[key] = meta
+            self.sizes[key] = self.size(code, category)
+
+    def remove(self, code, category):
+        """delete a stored statement"""
+        key = f"{code}_{category}"
+        with self.lock:
+            self.matrices.pop(key, None)
+            self.statements.pop(key, None)
+            self.versions.pop(key, None)
+            self.sizes.pop(key, None)
+            for path in (self.meta_path(code, category), self.matrix_path(code, category)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def size(self, code, category):
+        """bytes of the file of a stored statement"""
+        try:
+            return os.path.getsize(self.matrix_path(code, category))
+        except OSError:
+            return 0
+
+    def total_bytes(self):
+        """bytes of the files of the stored statements, kept up to date by put and remove"""
+        if not self.loaded:
+            for key in self.keys():
+                self.meta(*key.rsplit("_", 1))
+            self.loaded = True
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def matrix(self, code, category):
+        """the memory mapped matrix of a statement"""
+        key = f"{code}_{category}"
+        with self.lock:
+            if key not in self.matrices:
+                self.matrices[key] = np.load(self.matrix_path(code, category), mmap_mode="r")
+            return self.matrices[key]
+
+    def contains(self, code, category):
+        return self.meta(code, category) is not None
+
+    def get(self, code, category):
+        """return the Statement of a stock, None if it is not stored"""
+        meta = self.meta(code, category)
+        if meta is None:
+            return None
+        today = datetime.date.today().isoformat()
+        if meta.get("accessed_at") != today:
+            # 访问日期每天最多写一次
+            meta["accessed_at"] = today
+            with self.lock:
+                self.versions[f"{code}_{category}"] = self.write_meta(code, category, meta)
+        return Statement(meta["items"], meta["periods"], self.matrix(code, category))
+
+    def codes(self, category):
+        """codes of the stocks whose statement of category is stored"""
+        suffix = f"_{category}"
+        return [key[:-len(suffix)] for key in self.keys() if key.endswith(suffix)]
+
+    def line_item(self, category, item):
+        """
+        return {code: (periods, values)} of one item of all stored stocks,
+        only the row of the item is read from every file
+        """
+        result = {}
+        for code in self.codes(category):
+            meta = self.meta(code, category)
+            if meta is None or item not in meta["items"]:
+                continue
+            row = meta["items"].index(item)
+            result[code] = (meta["periods"], np.array(self.matrix(code, category)[row]))
+        return result
+
+    def import_csv(self, directory="cache"):
+        """
+        import the {code}_{category}_{date}.csv files written before,
+        the newest file of every stock and statement is kept
+        """
+        latest = {}
+        for path in sorted(glob.glob(os.path.join(directory, "*_*_*.csv"))):
+            code, category, _ = os.path.basename(path)[:-len(".csv")].split("_", 2)
+            if category in CATEGORIES:
+                latest[(code, category)] = path
+        for (code, category), path in latest.items():
+            fetched_at = datetime.date.fromtimestamp(os.path.getmtime(path)).isoformat()
+            with open(path, encoding="utf-8", newline="") as file:
+                self.put(code, category, list(csv.reader(file)), fetched_at)
+        return len(latest)
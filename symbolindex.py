@@ -0,0 +1,193 @@
+"""
+symbolindex.py
+本地的股票代码索引，用于输入股票时的提示
+
+所有 A 股、港股、美股的代码和名称一次性下载保存到本地，每天更新一次。
+输入的内容按代码前缀、名称子串和拼音首字母查找，不需要访问网络。
+"""
+import os
+import json
+import bisect
+import datetime
+import threading
+import httpclient
+
+
+SYMBOL_INDEX_PATH = "files/symbols.json"
+# 东方财富的股票列表接口
+SYMBOL_LIST_URL = "https://push2.eastmoney.com/api/qt/clist/get"
+SYMBOL_LIST_PAGE_SIZE = 1000
+# 类别 -> 东方财富的市场筛选条件
+SYMBOL_MARKETS = {
+    "A股": "m:0+t:6,m:0+t:80,m:1+t:2,m:1+t:23,m:0+t:81+s:2048",
+    "港股": "m:116+t:3,m:116+t:4,m:116+t:1,m:116+t:2",
+    "美股": "m:105,m:106,m:107",
+}
+# 最多返回的提示数量
+MAX_SUGGESTIONS = 10
+
+
+def pinyin_initials(name):
+    """拼音首字母，例如 兴业银行 -> XYYH"""
+    # pypinyin 导入时加载词典需要约 0.2 秒，只在下载股票列表时才需要
+    from pypinyin import lazy_pinyin, Style
+    return "".join(lazy_pinyin(name, style=Style.FIRST_LETTER)).upper()
+
+
+def fetch_market_symbols(category, fs):
+    """download [(code, category, name, pinyin initials)] of a market page by page"""
+    symbols = []
+    page = 1
+    while True:
+        params = {
+            "pn": page,
+            "pz": SYMBOL_LIST_PAGE_SIZE,
+            "po": 1,
+            "np": 1,
+            "fltt": 2,
+            "invt": 2,
+            "fid": "f12",
+            "fs": fs,
+            "fields": "f12,f14"}
+        response = httpclient.get(SYMBOL_LIST_URL, params=params)
+        response.raise_for_status()
+        data = response.json().get("data") or {}
+        items = data.get("diff") or []
+        symbols.extend((item["f12"], category, item["f14"], pinyin_initials(item["f14"])) for item in items)
+        if not items or len(symbols) >= data.get("total", 0):
+            return symbols
+        page += 1
+
+
+class SymbolIndex:
+    """
+    in-memory index of the symbol universe.
+
+    代码排序后用二分查找前缀；名称和拼音首字母分别拼接成一个字符串，
+    用 str.find 在 C 代码中查找子串，再用二分查找换算成第几只股票。
+    """
+    def __init__(self, path=SYMBOL_INDEX_PATH):
+        self.path = path
+        self.updated = None
+        self.lock = threading.Lock()
+        self.build([])
+        self.load()
+
+    def build(self, symbols):
+        """build the index of [(code, category, name, pinyin initials)]"""
+        symbols = sorted(symbols, key=lambda symbol: (symbol[0].upper(), symbol[1]))
+        codes = [symbol[0].upper() for symbol in symbols]
+        names = [symbol[2].upper() for symbol in symbols]
+        initials = [symbol[3] for symbol in symbols]
+
+        # 用 \n 分隔，查找的内容不会跨过两只股票
+        names_text = "\n".join(names)
+        names_offsets = []
+        offset = 0
+        for name in names:
+            names_offsets.append(offset)
+            offset += len(name) + 1
+        initials_text = "\n".join(initials)
+        initials_offsets = []
+        offset = 0
+        for initial in initials:
+            initials_offsets.append(offset)
+            offset += len(initial) + 1
+
+        # 一次替换所有结构，查找时不需要加锁
+        self.index = (symbols, codes, names_text, names_offsets, initials_text, initials_offsets)
+
+    def __len__(self):
+        return len(self.index[0])
+
+    def load(self):
+        """load the index saved by save(), return False if there is none"""
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return False
+        self.updated = data.get("updated")
+        self.build(tuple(symbol) for symbol in data.get("symbols", []))
+        return True
+
+    def save(self):
+        symbols = self.index[0]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"updated": self.updated, "symbols": symbols}, file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def is_stale(self):
+        """the index is refreshed once a day"""
+        return self.updated != datetime.date.today().isoformat()
+
+    def refresh(self):
+        """download the symbol universe, rebuild and save the index"""
+        with self.lock:
+            symbols = []
+            for category, fs in SYMBOL_MARKETS.items():
+                symbols.extend(fetch_market_symbols(category, fs))
+            if not symbols:
+                return
+            self.updated = datetime.date.today().isoformat()
+            self.build(symbols)
+            self.save()
+            print(f"{len(symbols)} symbols saved to {self.path}")
+
+    def refresh_if_stale(self):
+        """refresh in a background thread if the index is out of date"""
+        if self.is_stale():
+            threading.Thread(target=self.refresh_quietly, daemon=True).start()
+
+    def refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print("Some exception occured when refreshing the symbol index: ", e)
+
+    @staticmethod
+    def find_all(text, offsets, query, limit):
+        """indexes of the items containing query, at most limit"""
+        found = []
+        start = text.find(query)
+        while start != -1 and len(found) < limit:
+            i = bisect.bisect_right(offsets, start) - 1
+            found.append(i)
+            # 跳到下一只股票继续查找
+            next_start = offsets[i + 1] if i + 1 < len(offsets) else len(text)
+            start = text.find(query, next_start)
+        return found
+
+    def search(self, text, limit=MAX_SUGGESTIONS):
+        """
+        return at most limit dicts of Code, Category and Name: code prefix
+        matches first, then name substring and pinyin initials matches
+        """
+        symbols, codes, names_text, names_offsets, initials_text, initials_offsets = self.index
+        query = text.strip().upper()
+        if not query or "\n" in query:
+            return []
+
+        found = []
+        start = bisect.bisect_left(codes, query)
+        for i in range(start, min(start + limit, len(codes))):
+            if not codes[i].startswith(query):
+                break
+            found.append(i)
+        if len(found) < limit:
+            found.extend(self.find_all(names_text, names_offsets, query, limit))
+        if len(found) < limit:
+            found.extend(self.find_all(initials_text, initials_offsets, query, limit))
+
+        suggestions = []
+        seen = set()
+        for i in found:
+            if i in seen:
+                continue
+            seen.add(i)
+            code, category, name, _ = symbols[i]
+            suggestions.append({"Code": code, "Category": category, "Name": name})
+            if len(suggestions) >= limit:
+                break
+        return suggestions
@@ -1,10 +1,16 @@
 import sys
+import concurrent.futures
 from PyQt6.QtWidgets import (
     QWidget, QLineEdit, QListWidget,QTextEdit, QVBoxLayout, 
     QApplication, QDockWidget, QMainWindow, QStyle, QStyleOption)
-from PyQt6.QtCore import Qt, pyqtSignal, QPoint
+from PyQt6.QtCore import Qt, pyqtSignal, QPoint, QTimer
 from PyQt6.QtGui import QPainter
 import stockapi
+import symbolindex
+
+
+# 本地索引中找不到时，停止输入这么多毫秒后再请求网络
+REMOTE_SUGGEST_DELAY = 300
 
 
 class StockSearchWidget(QLineEdit):
@@ -15,10 +21,20 @@ class StockSearchWidget(QLineEdit):
     # 如果输入的信息能确定唯一的股票，或者用户选择了提示列表的某一项，
     # 触发该事件，该事件带一个字符串参数
     complete = pyqtSignal(str)
+    # 后台线程获取到网络提示后触发，参数为 (请求时的 generation, 提示列表)
+    remote_suggestions_ready = pyqtSignal(int, object)
 
     def __init__(self, parent=None):
         super().__init__()
         self.parent = parent
+        self.symbol_index = symbolindex.SymbolIndex()
+        self.symbol_index.refresh_if_stale()
+        # 每次输入变化加 1，用来丢弃过期的网络请求结果
+        self.generation = 0
+        self.remote_future = None
+        # 选中提示后程序设置文本时为 True，不再重新查找提示
+        self.choosing = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
         self.initializeUI()
 
         self.complete.connect(lambda x: print(f"{x} emit"))
@@ -41,6 +57,13 @@ class StockSearchWidget(QLineEdit):
         self.list_widget.itemClicked.connect(self.on_list_clicked)
         self.dock.setWidget(self.list_widget)
 
+        # 网络请求的去抖动定时器
+        self.remote_timer = QTimer(self)
+        self.remote_timer.setSingleShot(True)
+        self.remote_timer.setInterval(REMOTE_SUGGEST_DELAY)
+        self.remote_timer.timeout.connect(self.request_remote_suggestions)
+        self.remote_suggestions_ready.connect(self.update_remote_suggestions)
+
     def update_position(self):
         self_x = self.mapToGlobal(QPoint(0, 0)).x()
         self_y = self.mapToGlobal(QPoint(0, 0)).y()
@@ -72,40 +95,81 @@ class StockSearchWidget(QLineEdit):
             self.list_widget.setCurrentRow(row)
 
         elif event.key() == Qt.Key.Key_Return:
-            text = self.list_widget.currentItem().text()
-            self.complete.emit(text)
-            self.setText(text)
-            self.dock.setVisible(False)
+            self.choose_suggestion(self.list_widget.currentItem().text())
 
         else:
             print(event.key())
             super().keyPressEvent(event)
 
     def on_list_clicked(self, item):
-        text = item.text()
+        self.choose_suggestion(item.text())
+
+    def choose_suggestion(self, text):
         self.complete.emit(text)
+        self.choosing = True
         self.setText(text)
+        self.choosing = False
         self.dock.setVisible(False)
 
 
     def update_symbol_edit(self, text):
         """
-        根据input_str, 更新combobox的items
+        根据input_str, 更新combobox的items。
+        先在本地索引中查找，找不到时再请求网络
         """
-        if len(text) == 0:
+        self.generation += 1
+        self.remote_timer.stop()
+        if self.remote_future is not None:
+            # 还没有开始的请求直接取消，已经开始的请求结果会被丢弃
+            self.remote_future.cancel()
+            self.remote_future = None
+        if len(text) == 0 or self.choosing:
             self.dock.setVisible(False)
+            return
+
+        recommends = self.symbol_index.search(text)
+        if len(recommends) == 0:
+            self.dock.setVisible(False)
+            self.remote_timer.start()
         else:
+            self.show_suggestions(recommends)
+
+    def request_remote_suggestions(self):
+        """本地索引中没有的股票，在后台线程请求网络获取提示，不阻塞输入"""
+        text = self.text()
+        if len(text) == 0:
+            return
+        self.remote_future = self.executor.submit(self.fetch_remote_suggestions, self.generation, text)
+
+    def fetch_remote_suggestions(self, generation, text):
+        """runs in the executor thread"""
+        try:
             recommends = stockapi.get_recommend_stock(text)
-            if len(recommends) == 0:
-                self.dock.setVisible(False)
-            else:
-                self.list_widget.clear()
-                for stock in recommends:
-                    item_text = f"{stock['Code']}  {stock['Category']}  {stock['Name']}"
-                    self.list_widget.addItem(item_text)
-                    self.list_widget.setCurrentRow(0)
-                    self.update_position()
-                    self.dock.setVisible(True)
+        except Exception as e:
+            print("Some exception occured in get_recommend_stock: ", e)
+            recommends = []
+        self.remote_suggestions_ready.emit(generation, recommends)
+
+    def update_remote_suggestions(self, generation, recommends):
+        if generation != self.generation:
+            # 请求之后输入又变化了，结果已经过期
+            return
+        self.remote_future = None
+        if len(recommends) == 0:
+            self.dock.setVisible(False)
+        else:
+            self.show_suggestions(recommends)
+
+    def show_suggestions(self, recommends):
+        """一次性填充提示列表"""
+        items = [f"{stock['Code']}  {stock['Category']}  {stock['Name']}" for stock in recommends]
+        self.list_widget.setUpdatesEnabled(False)
+        self.list_widget.clear()
+        self.list_widget.addItems(items)
+        self.list_widget.setCurrentRow(0)
+        self.list_widget.setUpdatesEnabled(True)
+        self.update_position()
+        self.dock.setVisible(True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+"""
+test_ingest.py
+ingest.py 并发更新财务报表的测试
+
+用法: python -m pytest test_ingest.py
+"""
+import os
+import concurrent.futures
+import pytest
+
+pytest.importorskip("stockapi")
+import ingest
+import statementcache
+import statementstore
+
+
+CODES = [f"{600000 + i}" for i in range(400)]
+
+
+def fake_statement(code, category):
+    """rows in the format of stockapi.get_financial_statement"""
+    periods = ["2026-06-30", "2026-03-31", "2025-12-31", "2025-09-30"]
+    rows = [["报告日期"] + periods]
+    for i in range(40):
+        rows.append([f"{category}项目{i}"] + [str(int(code) + i + j) for j in range(len(periods))])
+    return rows
+
+
+@pytest.fixture
+def cache_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("cache")
+    monkeypatch.setattr(statementcache.stockapi, "get_financial_statement", fake_statement)
+    return tmp_path
+
+
+def test_ingest_statements_concurrently(cache_directory, capsys):
+    ingest.ingest_statements(None, CODES, max_workers=8)
+
+    assert "exception" not in capsys.readouterr().out
+    # 重新打开，只读取磁盘上的文件
+    store = statementstore.StatementStore()
+    assert len(store.keys()) == len(CODES) * len(statementstore.CATEGORIES)
+    statement = store.get(CODES[7], "lrb")
+    assert statement.periods[0] == "2026-06-30"
+    assert statement.values[0, 0] == int(CODES[7])
+
+
+def test_evict_while_ingesting(cache_directory):
+    store = statementstore.StatementStore()
+    cache = statementcache.StatementCache(store)
+    # 大约能保存一半的报表
+    cache.get(CODES[0], "lrb")
+    cache.max_bytes = cache.total_bytes() * len(CODES) // 2
+
+    def update(code):
+        for category in statementstore.CATEGORIES:
+            cache.get(code, category)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        for future in [executor.submit(update, code) for code in CODES]:
+            future.result()
+
+    assert cache.total_bytes() <= cache.max_bytes
+    keys = store.keys()
+    assert 0 < len(keys) < len(CODES) * len(statementstore.CATEGORIES)
+    # 运行中的合计与磁盘上的文件一致
+    on_disk = sum(store.size(*key.rsplit("_", 1)) for key in keys)
+    assert statementstore.StatementStore().total_bytes() == on_disk == store.total_bytes()